@@ -1,8 +1,12 @@
 import argparse
-import datetime
+import json
 
+import pandas as pd
 import pyspark.sql.functions as f
 from pyspark.sql import SparkSession, DataFrame
+from pyspark.sql.avro.functions import from_avro
+from pyspark.sql.streaming import StreamingQueryListener
+from pyspark.sql.streaming.state import GroupState, GroupStateTimeout
 from pyspark.sql.types import (
     StructType,
     StringType,
@@ -10,7 +14,6 @@ from pyspark.sql.types import (
     LongType,
     TimestampType,
     BooleanType,
-    StructField,
 )
 
 """
@@ -30,43 +33,275 @@ com.google.cloud.hosted.kafka:managed-kafka-auth-login-handler:1.0.5' --
 """
 
 
-# Create or update the in-memory table
-def update_state(new_values, prev_state):
-    bus_line = None
-    total_passengers = 0
-    total_capacity = 0
-    remaining_at_stop = 0
-
-    # The `prev_state` argument is the grouping key `bus_line_id`, an integer.
-    # The original code tried to access it as a list, causing a TypeError.
-    # This function now correctly processes the `new_values` to determine the state.
-    update_timestamp = datetime.datetime.now(datetime.UTC)
-    for value in new_values:
-        if value.last_stop:
-            # Remove the bus_ride_id by returning None
-            return None
-        else:
-            # Update the values with the latest data
-            bus_line = value.bus_line
-            remaining_at_stop = value.remaining_at_stop
-            total_passengers = value.total_passengers
-            total_capacity = value.total_capacity
-    return bus_line, remaining_at_stop, total_passengers, total_capacity, update_timestamp
+# State kept for every bus line, and rows emitted for it, by update_bus_line_state
+BUS_LINE_STATE_SCHEMA = (
+    "bus_line string, remaining_at_stop int, total_passengers int, total_capacity int, "
+    "event_time_ms long")
+BUS_LINE_OUTPUT_SCHEMA = (
+    "bus_line_id int, bus_line string, remaining_at_stop int, total_passengers int, "
+    "total_capacity int, event_timestamp timestamp, update_timestamp timestamp, active boolean")
+
+def to_int(value):
+    return None if pd.isna(value) else int(value)
+
+def bus_line_state_frame(bus_line_id, state, active):
+    bus_line, remaining_at_stop, total_passengers, total_capacity, event_time_ms = state
+    return pd.DataFrame({
+        "bus_line_id": [bus_line_id],
+        "bus_line": [bus_line],
+        "remaining_at_stop": [remaining_at_stop],
+        "total_passengers": [total_passengers],
+        "total_capacity": [total_capacity],
+        "event_timestamp": [pd.to_datetime(event_time_ms, unit="ms")],
+        "update_timestamp": [pd.Timestamp.now(tz="UTC").tz_localize(None)],
+        "active": [active],
+    })
+
+def update_bus_line_state(key, updates, state: GroupState, timeout_ms: int):
+    """
+    Keeps the latest update of every bus line as its state, with applyInPandasWithState.
+
+    Only the lines updated in the micro-batch are emitted, so the work done per batch follows
+    the new input rather than the whole history. A line ends when its latest update is at the
+    last stop, or when it had no update for `timeout_ms` of event time. It is then dropped from
+    the state, and emitted one last time as inactive.
+    """
+    (bus_line_id,) = key
+    if state.hasTimedOut:
+        previous = state.get
+        state.remove()
+        yield bus_line_state_frame(bus_line_id, previous, active=False)
+        return
+
+    latest = state.get if state.exists else None
+    last_stop = False
+    for pdf in updates:
+        event_times_ms = pdf["timestamp_at_stop"].astype("datetime64[ms]").astype("int64")
+        row = pdf.loc[event_times_ms.idxmax()]
+        event_time_ms = int(event_times_ms.max())
+        # updates may arrive out of order, the state only moves forward in event time
+        if latest is None or event_time_ms >= latest[4]:
+            latest = (
+                row["bus_line"],
+                to_int(row["remaining_at_stop"]),
+                to_int(row["total_passengers"]),
+                to_int(row["total_capacity"]),
+                event_time_ms,
+            )
+            last_stop = bool(row["last_stop"])
+
+    if last_stop:
+        state.remove()
+        yield bus_line_state_frame(bus_line_id, latest, active=False)
+        return
+    state.update(latest)
+    # the timeout must be later than the current watermark
+    state.setTimeoutTimestamp(max(latest[4] + timeout_ms, state.getCurrentWatermarkMs() + 1))
+    yield bus_line_state_frame(bus_line_id, latest, active=True)
+
+# Columns of the bus_state table, the staging table also has `active`
+BUS_STATE_COLUMNS = [
+    "bus_line_id", "bus_line", "remaining_at_stop", "total_passengers", "total_capacity",
+    "event_timestamp", "update_timestamp"]
+
+_bigquery_client = None
+
+def get_bigquery_client():
+    # the merge statements run on the driver, one client is enough
+    global _bigquery_client
+    if _bigquery_client is None:
+        from google.cloud import bigquery
+        _bigquery_client = bigquery.Client()
+    return _bigquery_client
+
+def create_bus_state_table(table):
+    """
+    Creates the bus state table the changes are merged into. A table of another version of
+    the job (an overwritten snapshot, or an appended changelog) has other columns, and only
+    holds derived state, so it is dropped and created again.
+    """
+    from google.api_core import exceptions
+
+    client = get_bigquery_client()
+    try:
+        columns = [field.name for field in client.get_table(table).schema]
+        if columns != BUS_STATE_COLUMNS:
+            print(f"Recreating {table}, its columns {columns} are outdated")
+            client.delete_table(table)
+    except exceptions.NotFound:
+        pass
+    client.query(f"""
+        CREATE TABLE IF NOT EXISTS `{table}` (
+            bus_line_id INT64, bus_line STRING, remaining_at_stop INT64,
+            total_passengers INT64, total_capacity INT64,
+            event_timestamp TIMESTAMP, update_timestamp TIMESTAMP)
+    """).result()
+
+def merge_bus_state(table, staging_table):
+    """
+    Merges the changed bus lines from the staging table into the bus state table.
+    Inactive lines are deleted, and a line is only changed by a newer event, so replaying a
+    micro-batch after a restart, or a late update, does not move the state back.
+    """
+    update_columns = ", ".join(f"{column} = changes.{column}" for column in BUS_STATE_COLUMNS)
+    insert_columns = ", ".join(BUS_STATE_COLUMNS)
+    get_bigquery_client().query(f"""
+        MERGE `{table}` AS state
+        USING `{staging_table}` AS changes
+        ON state.bus_line_id = changes.bus_line_id
+        WHEN MATCHED AND changes.event_timestamp >= state.event_timestamp
+            AND NOT changes.active THEN
+            DELETE
+        WHEN MATCHED AND changes.event_timestamp >= state.event_timestamp THEN
+            UPDATE SET {update_columns}
+        WHEN NOT MATCHED AND changes.active THEN
+            INSERT ({insert_columns}) VALUES ({insert_columns})
+    """).result()
 
 # Function to write a micro-batch to BigQuery
-def write_to_bigquery(df: DataFrame, epoch_id, table, gcs_bucket):
+def write_to_bigquery(df: DataFrame, epoch_id, table, staging_table):
     """
-    Writes a DataFrame to a BigQuery table, overwriting it completely.
+    Upserts the changed bus lines of a micro-batch into a BigQuery table.
+    The changes are written to a staging table with the Storage Write API, and then merged,
+    so the cost of a micro-batch follows the number of changed lines, not the whole state.
     This function is designed to be used with `forEachBatch`.
     """
     print(f"Writing to BigQuery at epoch {epoch_id}; {table}")
-    print(df.collect())
     df.write \
       .format("bigquery") \
-      .option("table", table) \
-      .option("temporaryGcsBucket", gcs_bucket) \
+      .option("table", staging_table) \
+      .option("writeMethod", "direct") \
       .mode("overwrite") \
       .save()
+    merge_bus_state(table, staging_table)
+
+def write_to_kafka_state_topic(df: DataFrame, epoch_id, kafka_options, topic):
+    """
+    Publishes the changed bus lines to a compacted topic, keyed by the bus line.
+    Lines that ended are deleted with a tombstone (a null value).
+    """
+    print(f"Writing bus lines to {topic} at epoch {epoch_id}")
+    df.select(
+        f.col("bus_line_id").cast("string").alias("key"),
+        f.when(f.col("active"), f.to_json(f.struct("*"))).alias("value")) \
+      .write \
+      .format("kafka") \
+      .options(**kafka_options) \
+      .option("topic", topic) \
+      .save()
+
+def log_batch_sample(df: DataFrame, epoch_id, sample_rows):
+    """Prints the size of a micro-batch and its first rows. Only meant for debugging."""
+    print(f"Epoch {epoch_id}: {df.count()} rows, first {sample_rows}: {df.take(sample_rows)}")
+
+def write_bus_state(df: DataFrame, epoch_id, table, staging_table, kafka_options, kafka_state_topic,
+                    debug_sample_rows=0):
+    # the batch is read more than once, compute it once.
+    # it is never collected to the driver, only a sample of it when debugging.
+    df.persist()
+    try:
+        if df.isEmpty():
+            return
+        if debug_sample_rows > 0:
+            log_batch_sample(df, epoch_id, debug_sample_rows)
+        if kafka_state_topic:
+            write_to_kafka_state_topic(df, epoch_id, kafka_options, kafka_state_topic)
+        write_to_bigquery(df, epoch_id, table, staging_table)
+    finally:
+        df.unpersist()
+
+def alert_messages(parsed_df: DataFrame) -> DataFrame:
+    """Returns the capacity alerts of the parsed bus updates, as Kafka messages."""
+    alert_df = parsed_df.filter(f.col("data.remaining_at_stop") > 0)
+    # Create a simple JSON string for the alert message, keyed by the bus line.
+    return alert_df.select(
+        f.col("data.bus_line_id").cast("string").alias("key"),
+        f.to_json(f.struct(
+            "data.bus_ride_id",
+            "data.bus_line_id",
+            "data.bus_line",
+            "data.bus_stop_id",
+            "data.remaining_at_stop",
+            "data.timestamp_at_stop"
+        )).alias("value"))
+
+def latest_bus_lines(parsed_df: DataFrame) -> DataFrame:
+    """
+    Returns the latest update of every bus line in a micro-batch, in the same shape as the
+    rows emitted by update_bus_line_state. Lines at their last stop are inactive.
+    """
+    latest = f.max_by(f.struct("data.*"), "data.timestamp_at_stop").alias("latest")
+    return parsed_df.groupBy("data.bus_line_id").agg(latest).select(
+        f.col("bus_line_id"),
+        f.col("latest.bus_line"),
+        f.col("latest.remaining_at_stop"),
+        f.col("latest.total_passengers"),
+        f.col("latest.total_capacity"),
+        f.col("latest.timestamp_at_stop").alias("event_timestamp"),
+        f.current_timestamp().alias("update_timestamp"),
+        (~f.coalesce(f.col("latest.last_stop"), f.lit(False))).alias("active"))
+
+def write_single_read_batch(df: DataFrame, epoch_id, kafka_options, alert_topic, table,
+                            staging_table, kafka_state_topic, debug_sample_rows=0):
+    """
+    Writes the alerts and the bus state from one micro-batch of parsed messages, so every
+    message is read from Kafka and parsed once. There is no streaming state: the latest update
+    of every line in the batch is merged, and the merge never moves a line back in time.
+    This function is designed to be used with `forEachBatch`.
+    """
+    df.persist()
+    try:
+        if df.isEmpty():
+            return
+        print(f"Writing alerts to {alert_topic} at epoch {epoch_id}")
+        alert_messages(df).write \
+          .format("kafka") \
+          .options(**kafka_options) \
+          .option("topic", alert_topic) \
+          .save()
+        write_bus_state(latest_bus_lines(df), epoch_id, table, staging_table,
+                        kafka_options, kafka_state_topic, debug_sample_rows)
+    finally:
+        df.unpersist()
+
+class BatchMetricsListener(StreamingQueryListener):
+    """
+    Prints the metrics of every micro-batch of every query as a JSON line.
+    The metrics are collected by Spark anyway, so this adds no work to the batches.
+    """
+
+    def onQueryStarted(self, event):
+        print(f"Query {event.name} started, id {event.id}")
+
+    def onQueryProgress(self, event):
+        progress = event.progress
+        durations = progress.durationMs
+        metrics = {
+            "query": progress.name,
+            "batch_id": progress.batchId,
+            "input_rows": progress.numInputRows,
+            "input_rows_per_second": progress.inputRowsPerSecond,
+            "processed_rows_per_second": progress.processedRowsPerSecond,
+            # rows emitted by the stateful operator, foreachBatch sinks do not report them
+            "output_rows": sum(op.numRowsUpdated for op in progress.stateOperators)
+                if progress.stateOperators else progress.sink.numOutputRows,
+            "state_rows": sum(op.numRowsTotal for op in progress.stateOperators),
+            "write_duration_ms": durations.get("addBatch"),
+            "trigger_duration_ms": durations.get("triggerExecution"),
+        }
+        print(f"Batch metrics: {json.dumps(metrics)}")
+
+    def onQueryIdle(self, event):
+        pass
+
+    def onQueryTerminated(self, event):
+        print(f"Query {event.id} terminated, exception: {event.exception}")
+
+def with_trigger(writer, trigger_interval):
+    """Runs the query every `trigger_interval` (e.g. "10 seconds"), or as fast as possible."""
+    if trigger_interval:
+        return writer.trigger(processingTime=trigger_interval)
+    return writer
 
 def run_pyspark(
         kafka_brokers: str, 
@@ -74,11 +309,29 @@ def run_pyspark(
         kafka_alert_topic: str, 
         spark_tmp_bucket: str, 
         spark_checkpoint_location: str,
-        bigquery_table: str):
+        bigquery_table: str,
+        wire_format: str = "json",
+        avro_schema_file: str = "bus-updates-value.avsc",
+        kafka_state_topic: str = None,
+        bus_line_timeout_minutes: int = 30,
+        bigquery_staging_table: str = None,
+        debug_sample_rows: int = 0,
+        trigger_interval: str = None,
+        max_offsets_per_trigger: int = None,
+        min_offsets_per_trigger: int = None,
+        max_trigger_delay: str = None,
+        shuffle_partitions: int = None,
+        single_read: bool = False):
+    builder = SparkSession.builder
+    if shuffle_partitions:
+        # Stateful queries keep the partition count of their first run, in the checkpoint
+        builder = builder.config("spark.sql.shuffle.partitions", shuffle_partitions)
     spark = (
-        SparkSession.builder
+        builder
         .config("spark.streaming.stopGracefullyOnShutdown", "true")
         .config("spark.sql.streaming.schemaInference", "true")
+        # Default of the BigQuery connector, for writes that go through GCS
+        .config("temporaryGcsBucket", spark_tmp_bucket)
         
         # The packages will be provided via the gcloud command instead.
         .appName("streaming-bus-updates-consumer")
@@ -86,6 +339,7 @@ def run_pyspark(
     )
     
     spark.sparkContext.setLogLevel("INFO")
+    spark.streams.addListener(BatchMetricsListener())
     
     # --- The rest of your script remains exactly the same ---
     print("defining schema")
@@ -117,102 +371,109 @@ def run_pyspark(
         .add("timestamp", TimestampType())
         .add("data", bus_data_schema))
     
+    # Connection options shared by every kafka source and sink
+    kafka_options = {
+        "kafka.bootstrap.servers": kafka_brokers,
+        "kafka.security.protocol": "SASL_SSL",
+        "kafka.sasl.mechanism": "OAUTHBEARER",
+        "kafka.sasl.login.callback.handler.class": "com.google.cloud.hosted.kafka.auth.GcpLoginCallbackHandler",
+        "kafka.sasl.jaas.config":
+            "org.apache.kafka.common.security.oauthbearer.OAuthBearerLoginModule required;",
+    }
+
+    # Bounds on the size of a micro-batch, unset options keep the Spark defaults
+    batch_size_options = {
+        name: str(value) for name, value in {
+            "maxOffsetsPerTrigger": max_offsets_per_trigger,
+            "minOffsetsPerTrigger": min_offsets_per_trigger,
+            "maxTriggerDelay": max_trigger_delay,
+        }.items() if value is not None
+    }
+
     print("starting stream read")
     kafka_df = (spark.readStream
                 .format("kafka")
-                .option("kafka.bootstrap.servers", kafka_brokers)
-                .option("kafka.security.protocol", "SASL_SSL")
-                .option("kafka.sasl.mechanism", "OAUTHBEARER")
-                .option("kafka.sasl.login.callback.handler.class", "com.google.cloud.hosted.kafka.auth.GcpLoginCallbackHandler")
-                .option("kafka.sasl.jaas.config", 
-                        "org.apache.kafka.common.security.oauthbearer.OAuthBearerLoginModule required;")
+                .options(**kafka_options)
+                .options(**batch_size_options)
                 .option("subscribe", kafka_input_topic)
                 .option("startingOffsets", "latest")
                 .load())
     
-    # Parse the JSON message from Kafka
-    print("parsing messages")
-    parsed_df = kafka_df.select(
-        f.from_json(
-            f.col("value").cast("string"), schema).alias("data")) \
-        .select("data.*")
+    # Parse the message from Kafka, either JSON or schemaless Avro binary
+    print(f"parsing {wire_format} messages")
+    if wire_format == "avro":
+        # The Avro schema file mirrors `schema` above, and is shipped with the job (--files)
+        with open(avro_schema_file) as schema_file:
+            avro_schema = schema_file.read()
+        parsed_df = kafka_df.select(
+            from_avro(f.col("value"), avro_schema).alias("data")) \
+            .select("data.*")
+    else:
+        parsed_df = kafka_df.select(
+            f.from_json(
+                f.col("value").cast("string"), schema).alias("data")) \
+            .select("data.*")
     parsed_df.printSchema()
+    # The bus state table holds the current lines only, changes are merged into it
+    bigquery_staging_table = bigquery_staging_table or f"{bigquery_table}_changes"
+    create_bus_state_table(bigquery_table)
+
+    if single_read:
+        # One query reads and parses the messages once, and writes both outputs
+        print("writing alerts and bus state from a single query")
+        single_read_writer = (parsed_df.writeStream
+            .queryName("write_alerts_and_bus_state")
+            .option("checkpointLocation", f"{spark_checkpoint_location}/single_read")
+            .foreachBatch(lambda df, epoch_id: write_single_read_batch(
+                df, epoch_id, kafka_options, kafka_alert_topic, bigquery_table,
+                bigquery_staging_table, kafka_state_topic, debug_sample_rows)))
+        with_trigger(single_read_writer, trigger_interval).start()
+        spark.streams.awaitAnyTermination()
+        return
+
     # --- Alert Logic ---
     print("creating alert dataframe")
-    alert_df = parsed_df.filter(f.col("data.remaining_at_stop") > 0)
-    alert_df.printSchema()
-    
-    # Create a simple JSON string for the alert message.
-    alert_df = alert_df.select(f.to_json(f.struct(
-        "data.bus_ride_id",
-        "data.bus_line",
-        "data.bus_stop_id",
-        "data.remaining_at_stop",
-        "data.timestamp_at_stop"
-    )).alias("value"))
+    alert_df = alert_messages(parsed_df)
     print("alert df json schema")
     alert_df.printSchema()
     # Write the alert messages to the alerts Kafka topic
     print("writing alerts df back to kafka")
-    (alert_df.writeStream
+    alert_writer = (alert_df.writeStream
         .format("kafka")
-        .option("kafka.bootstrap.servers", kafka_brokers)
-        .option("kafka.security.protocol", "SASL_SSL")
-        .option("kafka.sasl.mechanism", "OAUTHBEARER")
-        .option("kafka.sasl.login.callback.handler.class", "com.google.cloud.hosted.kafka.auth.GcpLoginCallbackHandler")
-        .option("kafka.sasl.jaas.config", 
-                "org.apache.kafka.common.security.oauthbearer.OAuthBearerLoginModule required;")
+        .options(**kafka_options)
         .option("topic", kafka_alert_topic)
         .option("checkpointLocation", spark_checkpoint_location)
-        .outputMode("append")
-        .start())
-    
-    
-    parsed_df_with_ts = parsed_df.withColumn("event_timestamp", f.col("data.timestamp_at_stop"))
+        .outputMode("append"))
+    with_trigger(alert_writer, trigger_interval).start()
 
     # Create a watermark to handle late data (adjust the time as needed)
-    watermarked_df = parsed_df_with_ts.withWatermark("event_timestamp", "10 minutes")
-
-    # Define the state schema
-    state_schema = StructType([
-        StructField("bus_line", StringType()),
-        StructField("remaining_at_stop", IntegerType()),
-        StructField("total_passengers", IntegerType()),
-        StructField("total_capacity", IntegerType()),
-        StructField("update_timestamp", TimestampType())
-    ])
-
-    spark.udf.register("stateful_function", update_state, state_schema)
-    
-    # Apply the stateful transformation
-    stateful_df = watermarked_df.select("data.*") \
+    # It also drives the event-time timeout of the bus lines state.
+    watermarked_df = parsed_df.select("data.*") \
+        .withWatermark("timestamp_at_stop", "10 minutes")
+
+    # Keep the latest update of every bus line as state, and emit the lines that changed
+    bus_line_timeout_ms = bus_line_timeout_minutes * 60 * 1000
+    stateful_df = watermarked_df \
         .groupBy("bus_line_id") \
-        .agg(f.collect_list(f.struct(
-            "bus_line",
-            "remaining_at_stop",
-            "total_passengers",
-            "total_capacity",
-            "last_stop"
-        )).alias("updates")) \
-        .withColumn("state", f.expr("stateful_function(updates, bus_line_id)")) \
-        .filter(f.col("state").isNotNull()) \
-        .withColumn("bus_line", f.col("state.bus_line")) \
-        .withColumn("remaining_at_stop", f.col("state.remaining_at_stop")) \
-        .withColumn("total_passengers", f.col("state.total_passengers")) \
-        .withColumn("total_capacity", f.col("state.total_capacity")) \
-        .withColumn("update_timestamp", f.col("state.update_timestamp")) \
-        .drop("updates", "state")
+        .applyInPandasWithState(
+            lambda key, updates, state: update_bus_line_state(key, updates, state, bus_line_timeout_ms),
+            outputStructType=BUS_LINE_OUTPUT_SCHEMA,
+            stateStructType=BUS_LINE_STATE_SCHEMA,
+            outputMode="update",
+            timeoutConf=GroupStateTimeout.EventTimeTimeout)
     print("stateful_df schema")
     stateful_df.printSchema()
     # Use forEachBatch to write to BigQuery, as direct streaming is not supported.
-    # The 'complete' output mode ensures each micro-batch contains the full state,
-    # which we then use to overwrite the BigQuery table.
-    (stateful_df.writeStream
+    # The 'update' output mode only passes the lines that changed in each micro-batch,
+    # which are then merged into the BigQuery table.
+    state_writer = (stateful_df.writeStream
         .queryName("write_latest_bus_data_to_bq")
-        .outputMode("complete")
-        .option("checkpointLocation", f"{spark_checkpoint_location}/stateful_bq")
-        .foreachBatch(lambda df, epoch_id: write_to_bigquery(df, epoch_id, bigquery_table, spark_tmp_bucket))
-        .start())
+        .outputMode("update")
+        .option("checkpointLocation", f"{spark_checkpoint_location}/bus_line_state")
+        .foreachBatch(lambda df, epoch_id: write_bus_state(
+            df, epoch_id, bigquery_table, bigquery_staging_table,
+            kafka_options, kafka_state_topic, debug_sample_rows)))
+    with_trigger(state_writer, trigger_interval).start()
     
     # Await termination for all streams
     spark.streams.awaitAnyTermination()
@@ -260,6 +521,84 @@ def pyspark_parse_args():
         required=True,
         help="Fully qualified BigQuery table name (e.g., project.dataset.table) to write bus state to."
     )
+    parser.add_argument(
+        "--wire-format",
+        type=str,
+        choices=["json", "avro"],
+        default="json",
+        help="Encoding of the incoming bus update messages."
+    )
+    parser.add_argument(
+        "--avro-schema-file",
+        type=str,
+        default="bus-updates-value.avsc",
+        help="Avro schema of the incoming bus update messages, used with --wire-format=avro."
+    )
+    parser.add_argument(
+        "--kafka-state-topic",
+        type=str,
+        default=None,
+        help="Optional compacted Kafka topic to publish the bus state to, keyed by bus line."
+    )
+    parser.add_argument(
+        "--bus-line-timeout-minutes",
+        type=int,
+        default=30,
+        help="Bus lines without updates for this long, in event time, are considered inactive."
+    )
+    parser.add_argument(
+        "--bigquery-staging-table",
+        type=str,
+        default=None,
+        help="BigQuery table the changed bus lines are written to before being merged. "
+             "Defaults to the bus state table name with a `_changes` suffix."
+    )
+    parser.add_argument(
+        "--debug-sample-rows",
+        type=int,
+        default=0,
+        help="Print the row count and this many rows of every bus state micro-batch. "
+             "For debugging only, as it runs extra Spark jobs per micro-batch."
+    )
+    parser.add_argument(
+        "--trigger-interval",
+        type=str,
+        default=None,
+        help="Processing time trigger of the queries, e.g. '10 seconds'. "
+             "By default a micro-batch starts as soon as the previous one is done."
+    )
+    parser.add_argument(
+        "--max-offsets-per-trigger",
+        type=int,
+        default=None,
+        help="Maximum number of Kafka offsets read per micro-batch."
+    )
+    parser.add_argument(
+        "--min-offsets-per-trigger",
+        type=int,
+        default=None,
+        help="Minimum number of Kafka offsets a micro-batch waits for, up to --max-trigger-delay."
+    )
+    parser.add_argument(
+        "--max-trigger-delay",
+        type=str,
+        default=None,
+        help="Longest a micro-batch is delayed by --min-offsets-per-trigger, e.g. '1m'."
+    )
+    parser.add_argument(
+        "--shuffle-partitions",
+        type=int,
+        default=None,
+        help="Number of shuffle partitions, which is the number of state store partitions "
+             "too. Only applies to a new checkpoint location."
+    )
+    parser.add_argument(
+        "--single-read",
+        action="store_true",
+        help="Read and parse the bus updates once, in a single query writing both the alerts "
+             "and the bus state. The state is then the latest update of every line, without "
+             "the --bus-line-timeout-minutes eviction."
+    )
 
     return parser.parse_args()
 
@@ -267,7 +606,4 @@ def pyspark_parse_args():
 if __name__ == "__main__":
     args = pyspark_parse_args()
     print(f"Running with args: {args}")
-    run_pyspark(
-        args.kafka_brokers, args.kafka_input_topic, args.kafka_alert_topic,
-        args.spark_tmp_bucket, args.spark_checkpoint_location, args.bigquery_table
-    )
\ No newline at end of file
+    run_pyspark(**vars(args))
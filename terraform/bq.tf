@@ -60,6 +60,25 @@ resource "google_project_iam_member" "ridership_dataset_sa_gcs_reader" {
   member = "serviceAccount:${google_bigquery_connection.cloud_resources_connection.cloud_resource[0].service_account_id}"
 }
 
+# Creates the table the capacity alerts are written to by the Kafka Connect BigQuery sink.
+# The alerts are schemaless JSON, so the sink cannot create or extend the table by itself,
+# and every field of the alerts must be declared here.
+resource "google_bigquery_table" "capacity_alerts" {
+  project             = var.project_id
+  dataset_id          = google_bigquery_dataset.ridership_lakehouse.dataset_id
+  table_id            = "capacity_alerts"
+  deletion_protection = false # set to "true" in production
+
+  schema = jsonencode([
+    { name = "bus_ride_id", type = "STRING", mode = "NULLABLE" },
+    { name = "bus_line_id", type = "INTEGER", mode = "NULLABLE" },
+    { name = "bus_line", type = "STRING", mode = "NULLABLE" },
+    { name = "bus_stop_id", type = "INTEGER", mode = "NULLABLE" },
+    { name = "remaining_at_stop", type = "INTEGER", mode = "NULLABLE" },
+    { name = "timestamp_at_stop", type = "TIMESTAMP", mode = "NULLABLE" },
+  ])
+}
+
 output "staging_dataset_id" {
   value = google_bigquery_dataset.ridership_lakehouse_staging.dataset_id
 }
@@ -79,6 +79,10 @@ resource "google_cloud_run_v2_service" "default" {
         name  = "KAFKA_ALERT_TOPIC"
         value = google_managed_kafka_topic.capacity_alerts.topic_id
       }
+      env {
+        name  = "KAFKA_STATE_TOPIC"
+        value = google_managed_kafka_topic.bus_state.topic_id
+      }
       env {
         name  = "SPARK_TMP_BUCKET"
         value = google_storage_bucket.spark_bucket.name
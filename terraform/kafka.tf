@@ -16,11 +16,12 @@
 locals {
   bus_updates_topic     = "bus-updates"
   capacity_alerts_topic = "capacity-alerts"
+  bus_state_topic       = "bus-state"
 }
 
 
 resource "google_managed_kafka_acl" "default" {
-  for_each = toset([local.bus_updates_topic, local.capacity_alerts_topic])
+  for_each = toset([local.bus_updates_topic, local.capacity_alerts_topic, local.bus_state_topic])
   acl_id   = "topic/${each.value}"
   cluster  = google_managed_kafka_cluster.default.cluster_id
   location = var.region
@@ -68,7 +69,7 @@ resource "google_managed_kafka_topic" "bus_updates" {
   cluster            = google_managed_kafka_cluster.default.cluster_id
   location           = var.region
   project            = var.project_id
-  partition_count    = 2
+  partition_count    = var.bus_updates_partition_count
   replication_factor = 3
 }
 
@@ -81,6 +82,19 @@ resource "google_managed_kafka_topic" "capacity_alerts" {
   replication_factor = 3
 }
 
+# Latest state of every bus line, published by the spark job and read by the webapp
+resource "google_managed_kafka_topic" "bus_state" {
+  topic_id           = local.bus_state_topic
+  cluster            = google_managed_kafka_cluster.default.cluster_id
+  location           = var.region
+  project            = var.project_id
+  partition_count    = 2
+  replication_factor = 3
+  configs = {
+    "cleanup.policy" = "compact"
+  }
+}
+
 resource "google_managed_kafka_connect_cluster" "default" {
   project            = var.project_id
   connect_cluster_id = "my-connect-cluster"
@@ -146,6 +160,8 @@ resource "google_managed_kafka_connector" "capactiy-alerts-bigquery-sink-connect
     "value.converter"                = "org.apache.kafka.connect.json.JsonConverter"
     "value.converter.schemas.enable" = "false"
     "defaultDataset"                 = google_bigquery_dataset.ridership_lakehouse.dataset_id
+    # the table declares every field of the alerts, including bus_line_id
+    "topic2TableMap"                 = "${google_managed_kafka_topic.capacity_alerts.topic_id}:${google_bigquery_table.capacity_alerts.table_id}"
   }
 
   provider = google-beta
@@ -21,4 +21,10 @@ variable "region" {
   type        = string
   description = "GCP Region"
   default     = "us-central1"
-}
\ No newline at end of file
+}
+
+variable "bus_updates_partition_count" {
+  type        = number
+  description = "Number of partitions of the bus-updates topic. Messages are keyed by bus line, so each line stays in order within its partition."
+  default     = 2
+}
@@ -0,0 +1,275 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Startup benchmark of the buses dashboard, as a proxy for Cloud Run cold starts.
+
+Every run starts fresh interpreters, and measures:
+- the time to import main.py, and the share of each module it imports (python -X importtime),
+- the time to first request, from starting a process serving the app to its first /healthz
+  response.
+
+The app runs with its default configuration. The GCP boundary is stubbed out: there are no
+credentials and no metadata server, and the Kafka bootstrap does not resolve. Anything that
+talks to GCP while starting shows up as a slower (or failing) startup, as on a cold start.
+
+Usage, from the webapp directory:
+    python benchmarks/startup.py                                # print the medians of a few runs
+    python benchmarks/startup.py --update-baseline --baseline baseline.json
+    python benchmarks/startup.py --check --baseline baseline.json
+
+Timings depend on the machine, so the baseline must be recorded on the machine running the
+check. The CI (.github/workflows/startup-benchmark.yaml) records it from the base branch of a
+pull request, with --app-dir, right before checking the pull request on the same runner.
+"""
+
+import argparse
+import ast
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+APP_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "buses-dashboard"
+)
+FIRST_REQUEST_TIMEOUT_SECONDS = 60
+# Shared CI runners vary by about 10-20% between two runs of the same code, and by a few tens
+# of milliseconds on sub-second timings, so smaller differences are not reported.
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_MIN_REGRESSION_SECONDS = 0.1
+
+# Prints the seconds it takes to import the app
+IMPORT_APP = """
+import time
+started_at = time.perf_counter()
+import main
+print(time.perf_counter() - started_at)
+"""
+
+# Serves the app from a fresh interpreter, on the port given as argument
+SERVE_APP = """
+import sys
+from werkzeug.serving import make_server
+import main
+make_server("127.0.0.1", int(sys.argv[1]), main.app, threaded=True).serve_forever()
+"""
+
+# main.py reads its configuration from the environment, placeholders are enough to start it.
+# Optional settings keep their defaults, as in production.
+PLACEHOLDER_ENVIRONMENT = {
+    "BQ_DATASET": "ridership_lakehouse",
+    "PROJECT_ID": "benchmark-project",
+    "GCS_MAIN_BUCKET": "benchmark-bucket",
+    "REGION": "us-central1",
+    # a remote bootstrap, so the Kafka clients authenticate with GCP as in production
+    "KAFKA_BOOTSTRAP": "bootstrap.benchmark.invalid:9092",
+    "KAFKA_TOPIC": "bus-updates",
+    "KAFKA_ALERT_TOPIC": "capacity-alerts",
+    "SPARK_TMP_BUCKET": "benchmark-spark-bucket",
+    "SPARK_CHECKPOINT_LOCATION": "gs://benchmark-spark-bucket/checkpoint",
+    "BIGQUERY_TABLE": "bus_state",
+    "SUBNET_URI": "benchmark-subnet",
+    "SERVICE_ACCOUNT": "benchmark@benchmark-project.iam.gserviceaccount.com",
+}
+
+# No credentials, and no metadata server to get them from: google.auth fails right away
+GCP_STUB_ENVIRONMENT = {
+    "NO_GCE_CHECK": "true",
+    "GCE_METADATA_HOST": "127.0.0.1:9",
+    "GCE_METADATA_IP": "127.0.0.1:9",
+}
+
+
+def get_environment(shared_state_dir: str) -> dict:
+    environment = {**PLACEHOLDER_ENVIRONMENT, **os.environ, **GCP_STUB_ENVIRONMENT}
+    environment.pop("GOOGLE_APPLICATION_CREDENTIALS", None)
+    environment["SHARED_STATE_DIR"] = shared_state_dir
+    return environment
+
+
+def get_main_imports(app_dir: str) -> list[str]:
+    """Returns the modules imported at the top level of main.py."""
+    with open(os.path.join(app_dir, "main.py")) as main_file:
+        tree = ast.parse(main_file.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules.append(node.module)
+    return modules
+
+
+def measure_imports(app_dir: str, environment: dict) -> tuple[float, dict]:
+    """Returns the import time of main.py, and of each module it imports, in seconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_APP],
+        cwd=app_dir,
+        env=environment,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1]
+        raise RuntimeError(f"Importing main.py failed: {error}")
+    # the app starts background threads while it is imported, which import modules too, so
+    # the nesting of the report is not reliable - the first import of a module is used instead
+    cumulative_seconds = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)", line)
+        if match is not None:
+            cumulative_seconds.setdefault(
+                match.group(2), int(match.group(1)) / 1_000_000
+            )
+    modules = {
+        module: cumulative_seconds[module]
+        for module in get_main_imports(app_dir)
+        if module in cumulative_seconds
+    }
+    return float(result.stdout.strip().splitlines()[-1]), modules
+
+
+def measure_first_request(app_dir: str, environment: dict) -> float:
+    """Returns the seconds from starting a process serving the app, to its first response."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    url = f"http://127.0.0.1:{port}/healthz"
+    started_at = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-c", SERVE_APP, str(port)],
+        cwd=app_dir,
+        env=environment,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started_at < FIRST_REQUEST_TIMEOUT_SECONDS:
+            if server.poll() is not None:
+                raise RuntimeError(f"The app exited with code {server.returncode}.")
+            try:
+                with urllib.request.urlopen(url, timeout=1):
+                    return time.perf_counter() - started_at
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise TimeoutError(f"No response from {url}.")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_benchmark(app_dir: str, runs: int) -> dict:
+    import_times, first_request_times, module_times = [], [], {}
+    with tempfile.TemporaryDirectory() as shared_state_dir:
+        environment = get_environment(shared_state_dir)
+        for _ in range(runs):
+            total, modules = measure_imports(app_dir, environment)
+            import_times.append(total)
+            for module, seconds in modules.items():
+                module_times.setdefault(module, []).append(seconds)
+            first_request_times.append(measure_first_request(app_dir, environment))
+    return {
+        "import_seconds": statistics.median(import_times),
+        "first_request_seconds": statistics.median(first_request_times),
+        "modules": {
+            module: statistics.median(times)
+            for module, times in sorted(
+                module_times.items(), key=lambda item: -statistics.median(item[1])
+            )
+        },
+    }
+
+
+def check_baseline(
+    results: dict, baseline_path: str, tolerance: float, min_regression_seconds: float
+) -> list[str]:
+    """
+    Returns the measurements that are slower than the baseline by more than `tolerance`
+    (relative) and by more than `min_regression_seconds`.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = []
+    for key in ("import_seconds", "first_request_seconds"):
+        limit = max(
+            baseline[key] * (1 + tolerance), baseline[key] + min_regression_seconds
+        )
+        if results[key] > limit:
+            regressions.append(
+                f"{key}: {results[key]:.3f}s, the baseline is {baseline[key]:.3f}s "
+                f"(at most {limit:.3f}s allowed)"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--modules", type=int, default=10, help="Slowest modules to show."
+    )
+    parser.add_argument(
+        "--app-dir", default=APP_DIR, help="Directory of the main.py to benchmark."
+    )
+    parser.add_argument("--baseline", help="JSON file of the baseline times.")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument(
+        "--min-regression-seconds", type=float, default=DEFAULT_MIN_REGRESSION_SECONDS
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+    if (args.check or args.update_baseline) and not args.baseline:
+        parser.error("--check and --update-baseline need a --baseline file")
+
+    results = run_benchmark(os.path.abspath(args.app_dir), args.runs)
+    print(f"Import main.py: {results['import_seconds'] * 1000:.0f} ms")
+    for module, seconds in list(results["modules"].items())[: args.modules]:
+        print(f"  {module}: {seconds * 1000:.0f} ms")
+    print(f"Time to first request: {results['first_request_seconds'] * 1000:.0f} ms")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(
+                {
+                    key: round(results[key], 3)
+                    for key in ("import_seconds", "first_request_seconds")
+                },
+                baseline_file,
+                indent=2,
+            )
+            baseline_file.write("\n")
+        print(f"Baseline updated: {args.baseline}")
+    if args.check:
+        regressions = check_baseline(
+            results, args.baseline, args.tolerance, args.min_regression_seconds
+        )
+        for regression in regressions:
+            print(f"Regression - {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regression against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Characters that must be escaped in JSON strings, other than backslash and quote
+CONTROL_CHARACTERS_PATTERN = "[\\x00-\\x1f]"
+
+
+class ArrowJsonEncoder:
+    """
+    Encodes whole Arrow record batches to JSON objects, one per row.
+
+    Every column is formatted at once with Arrow compute functions, and the columns are then
+    joined into JSON objects, so no Python object is created per value.
+    """
+
+    def encode(self, batch: pa.RecordBatch) -> list[bytes]:
+        """Returns the rows of `batch` as JSON encoded bytes."""
+        parts = []
+        for index, field in enumerate(batch.schema):
+            separator = "{" if index == 0 else ","
+            parts.append(f"{separator}{json.dumps(field.name)}:")
+            parts.append(self.encode_column(batch.column(index), field.type))
+        parts.append("}" if parts else "{}")
+        rows = pc.binary_join_element_wise(*parts, "")
+        return rows.cast(pa.binary()).to_pylist()
+
+    @staticmethod
+    def event_times(batch: pa.RecordBatch, column: str) -> list[float]:
+        """Returns the values of a timestamp column as seconds since the epoch."""
+        micros = batch.column(column).cast(pa.timestamp("us")).cast(pa.int64())
+        return pc.divide(micros.cast(pa.float64()), 1_000_000).to_pylist()
+
+    def encode_column(self, column: pa.Array, column_type: pa.DataType) -> pa.Array:
+        if pa.types.is_timestamp(column_type):
+            if column_type.tz is not None:
+                column = column.cast(pa.timestamp(column_type.unit, tz="UTC"))
+                encoded = pc.strftime(column, format='"%Y-%m-%dT%H:%M:%SZ"')
+            else:
+                encoded = pc.strftime(column, format='"%Y-%m-%dT%H:%M:%S"')
+        elif pa.types.is_string(column_type) or pa.types.is_large_string(column_type):
+            encoded = self.encode_strings(column)
+        elif pa.types.is_boolean(column_type) or pa.types.is_integer(column_type):
+            encoded = column.cast(pa.string())
+        elif pa.types.is_floating(column_type):
+            # NaN and infinity are not valid JSON
+            column = pc.if_else(pc.is_finite(column), column, None)
+            encoded = column.cast(pa.string())
+        else:
+            # anything else is rare enough to go through the standard json encoder
+            encoded = pa.array(
+                [json.dumps(value, default=str) for value in column.to_pylist()],
+                pa.string(),
+            )
+        return pc.fill_null(encoded, "null")
+
+    @staticmethod
+    def encode_strings(column: pa.Array) -> pa.Array:
+        if pc.any(pc.match_substring_regex(column, CONTROL_CHARACTERS_PATTERN)).as_py():
+            return pa.array(
+                [
+                    None if value is None else json.dumps(value)
+                    for value in column.to_pylist()
+                ],
+                pa.string(),
+            )
+        escaped = pc.replace_substring(column, "\\", "\\\\")
+        escaped = pc.replace_substring(escaped, '"', '\\"')
+        return pc.binary_join_element_wise('"', escaped, '"', "")
@@ -0,0 +1,54 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+
+import fastavro
+
+
+class AvroRideEncoder:
+    """
+    Encodes bus updates as schemaless Avro binary, to be parsed with `from_avro` by the Spark job.
+
+    Avro encodes a record as the concatenation of its fields, so the ride (the `data` field) is
+    encoded ahead of time, and only the small `id` and `timestamp` header is encoded per message.
+    """
+
+    def __init__(self, schema: dict):
+        fields = {field["name"]: field for field in schema["fields"]}
+        self.header_schema = fastavro.parse_schema(
+            {
+                "type": "record",
+                "name": f"{schema['name']}Header",
+                "fields": [fields["id"], fields["timestamp"]],
+            }
+        )
+        self.data_schema = fastavro.parse_schema(fields["data"]["type"])
+
+    @staticmethod
+    def write(schema, record) -> bytes:
+        buffer = io.BytesIO()
+        fastavro.schemaless_writer(buffer, schema, record)
+        return buffer.getvalue()
+
+    def encode(self, ride: dict) -> bytes:
+        return self.write(self.data_schema, ride)
+
+    def encode_message(self, message_id: int, timestamp: float, ride: bytes) -> bytes:
+        header = self.write(
+            self.header_schema,
+            {"id": message_id, "timestamp": int(timestamp * 1_000_000)},
+        )
+        return header + ride
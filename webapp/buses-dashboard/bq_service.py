@@ -13,23 +13,64 @@
 # limitations under the License.
 
 import datetime
-import logging
+import queue
+import threading
+from typing import TYPE_CHECKING
 
-from google.api_core import exceptions
-from google.cloud import bigquery
+from cache import CachedValue
+
+if TYPE_CHECKING:
+    from google.cloud import bigquery
 
 bigquery_client = None
 
 
 class BigQueryService:
-    client = None
+    # created on first use, and shared by every instance
+    shared_client = None
+    shared_client_lock = threading.Lock()
     DAYS_TO_QUERY = 10
+    RIDES_PAGE_SIZE = 5000
+    RIDES_PREFETCH_PAGES = 2
+    # bus lines are cached process wide, and revalidated with the table's modification time
+    BUS_LINES_TTL_SECONDS = 60
+    BUS_LINES_MAX_STALE_SECONDS = 3600
+    bus_lines_cache = None
+    bus_lines_cache_lock = threading.Lock()
 
     def __init__(self, bq_dataset: str):
-        self.client = bigquery.Client()
         self.bq_dataset = bq_dataset
 
+    @property
+    def client(self) -> "bigquery.Client":
+        if BigQueryService.shared_client is None:
+            with BigQueryService.shared_client_lock:
+                if BigQueryService.shared_client is None:
+                    # imported on first use, it is slow to import
+                    from google.cloud import bigquery
+
+                    BigQueryService.shared_client = bigquery.Client()
+        return BigQueryService.shared_client
+
     def get_all_bus_lines(self):
+        with BigQueryService.bus_lines_cache_lock:
+            if BigQueryService.bus_lines_cache is None:
+                BigQueryService.bus_lines_cache = CachedValue(
+                    self.query_all_bus_lines,
+                    self.BUS_LINES_TTL_SECONDS,
+                    self.BUS_LINES_MAX_STALE_SECONDS,
+                    version_loader=self.get_bus_lines_version,
+                )
+        return BigQueryService.bus_lines_cache.get()
+
+    def get_bus_lines_version(self):
+        """
+        The last modification time of the bus_lines table. It changes with every data or schema
+        change, including commits of a BigLake Iceberg table, and is read without running a job.
+        """
+        return self.client.get_table(f"{self.bq_dataset}.bus_lines").modified
+
+    def query_all_bus_lines(self):
         query = f"""
             SELECT
                 bus_line_id,
@@ -42,14 +83,71 @@ class BigQueryService:
         return [x for x in self.client.query(query).result()]
 
     def get_bus_state(self, table_name: str):
+        from google.api_core import exceptions
+
+        query = f"SELECT * FROM {self.bq_dataset}.{table_name}"
         try:
-            table_obj = self.client.get_table(f"{self.bq_dataset}.{table_name}")
+            return [dict(x) for x in self.client.query(query).result()]
         except exceptions.NotFound:
+            # the spark job did not create the table yet
             return []
-        query = f"SELECT * FROM {self.bq_dataset}.{table_name}"
-        return [dict(x) for x in self.client.query(query).result()]
 
-    def get_rides_data(self):
+    def query_rides_data(self, page_size: int = RIDES_PAGE_SIZE):
+        """
+        Runs the rides query, and returns a row iterator that fetches the results page by page.
+        The total number of rows is available upfront, as `total_rows`.
+        """
+        return self.client.query(self.get_rides_query()).result(page_size=page_size)
+
+    def iter_rides_batches(self, rows, prefetch_pages: int = RIDES_PREFETCH_PAGES):
+        """
+        Yields the pages of a `query_rides_data` iterator as columnar Arrow record batches, as
+        soon as the first page arrives. Pages are fetched in a background thread, holding at
+        most `prefetch_pages` pages in memory.
+        """
+        yield from self.prefetch(rows.to_arrow_iterable(), prefetch_pages)
+
+    @staticmethod
+    def prefetch(pages, prefetch_pages: int):
+        """Iterates over `pages` in a background thread, staying at most `prefetch_pages` ahead."""
+        prefetched = queue.Queue(maxsize=prefetch_pages)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    prefetched.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch_pages():
+            try:
+                for page in pages:
+                    if not put(page):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        threading.Thread(target=fetch_pages, daemon=True).start()
+        try:
+            while (page := prefetched.get()) is not None:
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            # let the fetching thread know no more pages are needed
+            stopped.set()
+
+    def get_rides_cache_key(self):
+        """Identifies the results of the rides query, the window moves with the current date."""
+        today = datetime.datetime.now(datetime.UTC).date()
+        return f"{self.bq_dataset}-{self.DAYS_TO_QUERY}d-{today.isoformat()}"
+
+    def get_rides_query(self):
         now = datetime.datetime.now(datetime.UTC)
         start_timestamp = (now - datetime.timedelta(days=self.DAYS_TO_QUERY)).replace(
             year=2024
@@ -82,17 +180,15 @@ class BigQueryService:
         WHERE 
             timestamp_at_stop BETWEEN TIMESTAMP('{start_timestamp.strftime("%Y-%m-%dT%H:%M:%S")}')
                 AND TIMESTAMP('{stop_timestamp.strftime("%Y-%m-%dT%H:%M:%S")}')
+        ORDER BY timestamp_at_stop
         """
-        return [dict(x) for x in self.client.query(query).result()]
+        return query
 
-    def clear_table(self, bigquery_table):
-        # make sure the table exists
-        try:
-            self.client.get_table(f"{self.bq_dataset}.{bigquery_table}")
-        except exceptions.NotFound:
-            logging.info(
-                f"Drop operation - Table {self.bq_dataset}.{bigquery_table} not found. Skipping"
-            )
-            return
-        query = f"DELETE FROM {self.bq_dataset}.{bigquery_table} WHERE 1=1;"
-        self.client.query(query).result()
+    def drop_table(self, bigquery_table):
+        """
+        Drops a table written by the spark job, rather than deleting its rows, so the job
+        creates it again with the schema of its current version.
+        """
+        self.client.delete_table(
+            f"{self.bq_dataset}.{bigquery_table}", not_found_ok=True
+        )
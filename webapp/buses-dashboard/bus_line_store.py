@@ -0,0 +1,162 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import confluent_kafka
+
+
+class BusLineStore:
+    """
+    The latest state and capacity alert of every bus line, as consumed from Kafka.
+
+    The store is bounded: past `max_lines`, the lines that were not updated for the longest
+    time are dropped. Alerts are applied over the state of their line when they arrived after it,
+    so alerts keep the dashboard fresh between two state updates.
+    """
+
+    def __init__(self, max_lines: int = 10000):
+        self.max_lines = max_lines
+        self.lock = threading.Lock()
+        self.states = OrderedDict()  # bus_line_id -> (received_at, row)
+        self.alerts = OrderedDict()  # bus_line_id -> (received_at, alert)
+        self.has_state = False
+
+    def put_state(self, bus_line_id, row):
+        """Stores the state of a line, or removes the line when `row` is None (a tombstone)."""
+        with self.lock:
+            self.has_state = True
+            if row is None:
+                self.states.pop(bus_line_id, None)
+                self.alerts.pop(bus_line_id, None)
+                return
+            self.put(self.states, bus_line_id, row)
+
+    def clear(self):
+        """Drops every line, e.g. when a new job starts, until the new state arrives."""
+        with self.lock:
+            self.states.clear()
+            self.alerts.clear()
+            self.has_state = False
+
+    def get_line_ids(self) -> list:
+        with self.lock:
+            return list(self.states)
+
+    def put_alert(self, bus_line_id, alert):
+        with self.lock:
+            self.put(self.alerts, bus_line_id, alert)
+
+    def put(self, entries: OrderedDict, bus_line_id, value):
+        entries[bus_line_id] = (time.monotonic(), value)
+        entries.move_to_end(bus_line_id)
+        while len(entries) > self.max_lines:
+            entries.popitem(last=False)
+
+    def get_rows(self) -> list:
+        """Returns the state of every line in the store, with the newer alerts applied."""
+        with self.lock:
+            return [
+                self.apply_alert(bus_line_id, row, received_at)
+                for bus_line_id, (received_at, row) in self.states.items()
+            ]
+
+    def apply_alerts(self, rows: list, loaded_at: float, key_field="bus_line_id"):
+        """
+        Applies the alerts received after `loaded_at` (a `time.monotonic()` value) over
+        `rows`, typically loaded from BigQuery when the store does not have the state itself.
+        """
+        with self.lock:
+            return [self.apply_alert(row[key_field], row, loaded_at) for row in rows]
+
+    def apply_alert(self, bus_line_id, row, received_at):
+        alert_received_at, alert = self.alerts.get(bus_line_id, (None, None))
+        if alert is None or alert_received_at < received_at:
+            return row
+        return {
+            **row,
+            "remaining_at_stop": alert["remaining_at_stop"],
+            "last_alert": alert,
+        }
+
+
+class BusLineConsumer:
+    """
+    Consumes the capacity alerts, and optionally the compacted bus state topic, into a
+    `BusLineStore` from a background thread.
+
+    The state topic is always read from the beginning, so the store holds the full state as
+    soon as the consumer caught up, while only new alerts are of interest.
+    """
+
+    POLL_TIMEOUT_SECONDS = 1
+
+    def __init__(
+        self,
+        store: BusLineStore,
+        consumer: confluent_kafka.Consumer,
+        alert_topic: str,
+        state_topic: str = None,
+    ):
+        self.store = store
+        self.consumer = consumer
+        self.alert_topic = alert_topic
+        self.state_topic = state_topic
+
+    def start(self):
+        threading.Thread(target=self.run, name="bus-line-consumer", daemon=True).start()
+
+    def run(self):
+        topics = [self.alert_topic] + ([self.state_topic] if self.state_topic else [])
+        self.consumer.subscribe(topics, on_assign=self.on_assign)
+        while True:
+            try:
+                message = self.consumer.poll(self.POLL_TIMEOUT_SECONDS)
+                if message is None:
+                    continue
+                if message.error():
+                    logging.warning(
+                        f"Failed consuming bus line updates: {message.error()}"
+                    )
+                    continue
+                self.handle_message(message)
+            except Exception as e:
+                logging.exception(e)
+
+    def on_assign(self, consumer, partitions):
+        for partition in partitions:
+            if partition.topic == self.state_topic:
+                partition.offset = confluent_kafka.OFFSET_BEGINNING
+        consumer.assign(partitions)
+
+    def handle_message(self, message):
+        value = message.value()
+        if message.topic() == self.state_topic:
+            if value is None:
+                key = message.key()
+                if key is not None:
+                    self.store.put_state(int(key), None)
+                return
+            row = json.loads(value)
+            self.store.put_state(row["bus_line_id"], row)
+            return
+        alert = json.loads(value)
+        # alerts of older versions of the spark job do not name the line
+        if alert.get("bus_line_id") is not None:
+            self.store.put_alert(alert["bus_line_id"], alert)
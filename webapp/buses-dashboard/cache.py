@@ -0,0 +1,92 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import threading
+import time
+
+
+class CachedValue:
+    """
+    A cached value, with time based expiry and stale-while-revalidate refresh.
+
+    Within `ttl_seconds` of loading, the cached value is returned as is. For `max_stale_seconds`
+    after that, the stale value is still returned, while a single background refresh runs. Only
+    older (or missing) values are loaded synchronously, and concurrent callers share that load.
+
+    With a `version_loader`, a refresh first loads a cheap version of the source (e.g. the
+    modification time of a table), and only reloads the value when the version changed.
+    """
+
+    def __init__(
+        self,
+        loader,
+        ttl_seconds: float,
+        max_stale_seconds: float = 0,
+        version_loader=None,
+    ):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self.version_loader = version_loader
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.refreshing = False
+        self.value = None
+        self.version = None
+        self.loaded_at = None
+
+    def age(self):
+        if self.loaded_at is None:
+            return None
+        return time.monotonic() - self.loaded_at
+
+    def get(self):
+        age = self.age()
+        if age is None or age > self.ttl_seconds + self.max_stale_seconds:
+            return self.refresh()
+        if age > self.ttl_seconds:
+            self.refresh_in_background()
+        return self.value
+
+    def refresh(self):
+        """Loads the value, unless it was already refreshed while waiting for another load."""
+        with self.refresh_lock:
+            age = self.age()
+            if age is not None and age <= self.ttl_seconds:
+                return self.value
+            version = self.version_loader() if self.version_loader else None
+            if self.loaded_at is None or version is None or version != self.version:
+                self.value = self.loader()
+                self.version = version
+            self.loaded_at = time.monotonic()
+            return self.value
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep serving the stale value, the next call will try again
+                logging.exception(e)
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
@@ -0,0 +1,245 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import bisect
+import collections
+import json
+import logging
+import random
+import threading
+import time
+
+
+class DeliveryMetrics:
+    """
+    Aggregates the delivery reports of the kafka producers, instead of logging every message.
+
+    Delivered, failed and retried counts, and a histogram of the delivery latencies, are logged
+    once every `flush_interval_seconds`. Individual messages are only logged for a random sample,
+    a `log_sample_rate` fraction of them.
+    Running totals, throughput, latency percentiles and errors by code are kept for `get_stats`
+    and `to_prometheus`.
+    """
+
+    LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    # Percentiles are computed over the latest latencies, and rates over the latest seconds
+    LATENCY_SAMPLE_SIZE = 10000
+    RATE_WINDOW_SECONDS = 10
+
+    def __init__(self, flush_interval_seconds: float = 10, log_sample_rate: float = 0):
+        self.flush_interval_seconds = flush_interval_seconds
+        self.log_sample_rate = log_sample_rate
+        self.lock = threading.Lock()
+        # retries are reported in the statistics of each producer, as a running total
+        self.producer_retries = {}
+        self.delivered_total = 0
+        self.failed_total = 0
+        self.delivered_bytes_total = 0
+        self.errors_by_code = collections.Counter()
+        self.latency_bucket_totals = [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+        self.latency_sum_seconds = 0.0
+        self.latest_latencies = collections.deque(maxlen=self.LATENCY_SAMPLE_SIZE)
+        # [second, messages, bytes] delivered in each of the latest seconds
+        self.latest_seconds = collections.deque()
+        self.reset()
+
+    def reset(self):
+        self.flushed_at = time.monotonic()
+        self.delivered = 0
+        self.failed = 0
+        self.retried = sum(self.producer_retries.values())
+        # the last bucket counts latencies above the largest bound
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+
+    def should_sample(self) -> bool:
+        return self.log_sample_rate > 0 and random.random() < self.log_sample_rate
+
+    def on_delivery(self, error, message):
+        """Delivery report callback, for the producers' `on_delivery`."""
+        latency = message.latency()
+        with self.lock:
+            if error is not None:
+                self.failed += 1
+                self.failed_total += 1
+                self.errors_by_code[error.name()] += 1
+                first_failure = self.failed == 1
+            else:
+                self.delivered += 1
+                self.delivered_total += 1
+                self.delivered_bytes_total += len(message)
+                self.count_second(len(message))
+            if latency is not None:
+                bucket = bisect.bisect_left(self.LATENCY_BUCKETS_MS, latency * 1000)
+                self.latency_counts[bucket] += 1
+                self.latency_bucket_totals[bucket] += 1
+                self.latency_sum_seconds += latency
+                self.latest_latencies.append(latency)
+        if error is not None:
+            # failures are counted too, only the first one of every interval is always logged
+            if first_failure or self.should_sample():
+                logging.error(f"Message delivery failed: {error}")
+        elif self.should_sample():
+            logging.info(
+                f"Message delivered to topic '{message.topic()}' partition [{message.partition()}] offset {message.offset()}"
+            )
+        if time.monotonic() - self.flushed_at >= self.flush_interval_seconds:
+            self.flush()
+
+    def count_second(self, message_bytes: int):
+        second = int(time.monotonic())
+        if self.latest_seconds and self.latest_seconds[-1][0] == second:
+            self.latest_seconds[-1][1] += 1
+            self.latest_seconds[-1][2] += message_bytes
+        else:
+            self.latest_seconds.append([second, 1, message_bytes])
+        while self.latest_seconds[0][0] <= second - self.RATE_WINDOW_SECONDS:
+            self.latest_seconds.popleft()
+
+    def on_stats(self, stats_json: str):
+        """Statistics callback, for the producers' `stats_cb`."""
+        stats = json.loads(stats_json)
+        retries = sum(
+            broker.get("txretries", 0) for broker in stats.get("brokers", {}).values()
+        )
+        with self.lock:
+            self.producer_retries[stats["name"]] = retries
+
+    def flush(self):
+        """Logs the metrics aggregated since the last flush, and starts over."""
+        with self.lock:
+            elapsed = time.monotonic() - self.flushed_at
+            delivered, failed = self.delivered, self.failed
+            retried = sum(self.producer_retries.values()) - self.retried
+            latency_counts = self.latency_counts
+            self.reset()
+        if not delivered and not failed:
+            return
+        histogram = ", ".join(
+            f"{label}: {count}"
+            for label, count in zip(self.latency_labels(), latency_counts)
+            if count
+        )
+        logging.info(
+            f"Kafka deliveries in the last {elapsed:.1f}s: {delivered} delivered, {failed} failed, "
+            f"{retried} retried. Latency histogram: {histogram}"
+        )
+
+    def latency_labels(self) -> list[str]:
+        labels = [f"<={bound}ms" for bound in self.LATENCY_BUCKETS_MS]
+        labels.append(f">{self.LATENCY_BUCKETS_MS[-1]}ms")
+        return labels
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            latencies = sorted(self.latest_latencies)
+            now = int(time.monotonic())
+            recent = [
+                (messages, message_bytes)
+                for second, messages, message_bytes in self.latest_seconds
+                if second > now - self.RATE_WINDOW_SECONDS
+            ]
+            stats = {
+                "delivered_messages": self.delivered_total,
+                "failed_messages": self.failed_total,
+                "retried_messages": sum(self.producer_retries.values()),
+                "delivered_bytes": self.delivered_bytes_total,
+                "errors": dict(self.errors_by_code),
+            }
+        stats["messages_per_second"] = (
+            sum(messages for messages, _ in recent) / self.RATE_WINDOW_SECONDS
+        )
+        stats["bytes_per_second"] = (
+            sum(message_bytes for _, message_bytes in recent) / self.RATE_WINDOW_SECONDS
+        )
+        stats["latency_ms"] = {
+            f"p{percentile}": (
+                round(latencies[(len(latencies) - 1) * percentile // 100] * 1000, 3)
+                if latencies
+                else None
+            )
+            for percentile in (50, 95, 99)
+        }
+        return stats
+
+    def to_prometheus(self) -> list[str]:
+        """Returns the running totals in the Prometheus text exposition format, one line per item."""
+        stats = self.get_stats()
+        with self.lock:
+            bucket_totals = list(self.latency_bucket_totals)
+            latency_sum_seconds = self.latency_sum_seconds
+        lines = prometheus_metric(
+            "kafka_producer_messages_total",
+            "counter",
+            "Messages reported by the kafka simulation producers, by delivery result.",
+            {
+                '{result="delivered"}': stats["delivered_messages"],
+                '{result="failed"}': stats["failed_messages"],
+            },
+        )
+        lines += prometheus_metric(
+            "kafka_producer_retries_total",
+            "counter",
+            "Produce requests retried by the kafka simulation producers.",
+            {"": stats["retried_messages"]},
+        )
+        lines += prometheus_metric(
+            "kafka_producer_delivered_bytes_total",
+            "counter",
+            "Message bytes delivered by the kafka simulation producers.",
+            {"": stats["delivered_bytes"]},
+        )
+        lines += prometheus_metric(
+            "kafka_producer_errors_total",
+            "counter",
+            "Failed deliveries, by error code.",
+            {f'{{code="{code}"}}': count for code, count in stats["errors"].items()},
+        )
+        lines += prometheus_metric(
+            "kafka_producer_messages_per_second",
+            "gauge",
+            f"Messages delivered per second, over the last {self.RATE_WINDOW_SECONDS} seconds.",
+            {"": stats["messages_per_second"]},
+        )
+        lines += prometheus_metric(
+            "kafka_producer_bytes_per_second",
+            "gauge",
+            f"Bytes delivered per second, over the last {self.RATE_WINDOW_SECONDS} seconds.",
+            {"": stats["bytes_per_second"]},
+        )
+        histogram = {}
+        cumulative_count = 0
+        for bound, count in zip(self.LATENCY_BUCKETS_MS, bucket_totals):
+            cumulative_count += count
+            histogram[f'_bucket{{le="{bound / 1000}"}}'] = cumulative_count
+        histogram['_bucket{le="+Inf"}'] = sum(bucket_totals)
+        histogram["_sum"] = latency_sum_seconds
+        histogram["_count"] = sum(bucket_totals)
+        lines += prometheus_metric(
+            "kafka_producer_delivery_latency_seconds",
+            "histogram",
+            "Time from producing a message until its delivery report.",
+            histogram,
+        )
+        return lines
+
+
+def prometheus_metric(name: str, metric_type: str, help_text: str, samples: dict):
+    """
+    Formats a metric in the Prometheus text exposition format.
+    `samples` maps a suffix of the metric name (e.g. labels) to the sample value.
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    lines += [f"{name}{suffix} {value}" for suffix, value in samples.items()]
+    return lines
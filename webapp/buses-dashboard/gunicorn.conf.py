@@ -0,0 +1,48 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Production serving of the dashboard, with: gunicorn --config gunicorn.conf.py
+#
+# Every worker process imports the app on its own (no preloading), as the gRPC based clients
+# must not be shared across a fork. The workers coordinate through the files of
+# SHARED_STATE_DIR: the kafka producer runs in a single worker, and a single worker polls
+# the spark job status, whichever of them serves the requests.
+
+import logging
+import os
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = "main:app"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# Requests are mostly waiting on the network, and each dashboard holds a thread for its
+# /events stream, so workers run many threads. Only EVENTS_MAX_CONNECTIONS streams are
+# accepted per worker (see main.py), the other threads are kept for the other routes.
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 10
+preload_app = False
+
+accesslog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+
+
+def post_worker_init(worker):
+    import google.cloud.logging
+
+    google.cloud.logging.Client().setup_logging()
+    logging.basicConfig(level=logging.INFO)
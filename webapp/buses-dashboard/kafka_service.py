@@ -16,12 +16,22 @@ import _struct
 import json
 import logging
 import os
+import queue
+import threading
 import time
+import uuid
 import confluent_kafka
 from confluent_kafka import KafkaException
-from confluent_kafka.serialization import Serializer, SerializationError
+from confluent_kafka.serialization import (
+    Serializer,
+    SerializationError,
+    StringSerializer,
+)
 
 from bq_service import BigQueryService
+from delivery_metrics import DeliveryMetrics, prometheus_metric
+from rate_limiter import RateLimiter
+from replay_scheduler import ReplayScheduler
 from token_provider import TokenProvider
 
 
@@ -29,6 +39,9 @@ class JsonSerializer(Serializer):
     def __call__(self, obj, ctx=None):
         if obj is None:
             return None
+        if isinstance(obj, bytes):
+            # already encoded, see KafkaService.build_message
+            return obj
         try:
             return json.dumps(obj, default=str).encode("utf-8")
         except _struct.error as e:
@@ -36,80 +49,382 @@ class JsonSerializer(Serializer):
 
 
 class KafkaService:
-    producer: confluent_kafka.SerializingProducer = None
     total_messages = 0
-    sent_messages = 0
+    # messages sent by each of the producer workers
+    worker_sent_messages = []
+    # producers of the current (or latest) stream, one per worker
+    producers = []
+    delivery_metrics = DeliveryMetrics()
     token_provider = TokenProvider()
 
+    # Let librdkafka group messages into batches instead of sending them one by one.
+    # These only matter in batched mode, as flush() sends whatever is queued right away.
+    LINGER_MS = 20
+    BATCH_SIZE_BYTES = 1024 * 1024
+    MAX_IN_FLIGHT_MESSAGES = 100000
+    # Rides waiting to be sent by each producer worker
+    WORKER_QUEUE_SIZE = 10000
+
     @classmethod
-    def get_kafka_producer(cls, bootstrap_servers="localhost:29092"):
+    def create_kafka_producer(
+        cls, bootstrap_servers="localhost:29092", partitioner="murmur2_random"
+    ):
         config = {
             "bootstrap.servers": bootstrap_servers,
+            "key.serializer": StringSerializer("utf_8"),
             "value.serializer": JsonSerializer(),
+            # murmur2 matches the Java client, so keys land on the same partitions
+            "partitioner": partitioner,
+            "linger.ms": cls.LINGER_MS,
+            "batch.size": cls.BATCH_SIZE_BYTES,
+            "queue.buffering.max.messages": cls.MAX_IN_FLIGHT_MESSAGES,
+            "compression.type": "lz4",
+            # the statistics are only used to count retries
+            "statistics.interval.ms": int(
+                cls.delivery_metrics.flush_interval_seconds * 1000
+            ),
+            "stats_cb": cls.delivery_metrics.on_stats,
+        }
+        cls.add_security_config(config)
+        return confluent_kafka.SerializingProducer(config)
+
+    @classmethod
+    def create_kafka_consumer(cls, bootstrap_servers="localhost:29092", group_id=None):
+        """
+        Creates a consumer of its own group by default, so every process sees all messages.
+        Offsets are never committed, consumers start from the latest messages.
+        """
+        config = {
+            "bootstrap.servers": bootstrap_servers,
+            "group.id": group_id or f"buses-dashboard-{uuid.uuid4()}",
+            "enable.auto.commit": False,
+            "auto.offset.reset": "latest",
         }
-        if not bootstrap_servers.startswith("localhost"):
+        cls.add_security_config(config)
+        return confluent_kafka.Consumer(config)
+
+    @classmethod
+    def add_security_config(cls, config):
+        if not config["bootstrap.servers"].startswith("localhost"):
             # assume prod env
             config["security.protocol"] = "SASL_SSL"
             config["sasl.mechanism"] = "OAUTHBEARER"
             config["oauth_cb"] = cls.token_provider.get_token
 
-        if cls.producer is None:
-            cls.producer = confluent_kafka.SerializingProducer(config)
-        return cls.producer
+    @classmethod
+    def produce_message(cls, producer_instance, topic, message, key=None):
+        """Queues a message, waiting for in-flight messages to drain if the local queue is full."""
+        while True:
+            try:
+                producer_instance.produce(
+                    topic,
+                    key=key,
+                    value=message,
+                    on_delivery=cls.delivery_metrics.on_delivery,
+                )
+                return
+            except BufferError:
+                producer_instance.poll(1)
+
+    @classmethod
+    def delete_keys(cls, bootstrap_servers, topic, keys):
+        """Writes a tombstone for every key, so a compacted topic drops them."""
+        producer = cls.create_kafka_producer(bootstrap_servers)
+        for key in keys:
+            producer.produce(topic, key=str(key), value=None)
+        producer.flush()
+
+    @classmethod
+    def get_rides_batches(cls, bigquery_client, rides_cache=None):
+        """Returns the rides as Arrow record batches, replaying them from `rides_cache` when possible."""
+        cache_key = bigquery_client.get_rides_cache_key()
+        cached_rides = rides_cache.read(cache_key) if rides_cache else None
+        if cached_rides is not None:
+            logging.info(f"Replaying rides data from the cache ({cache_key}).")
+            cls.total_messages = cached_rides.num_rows
+            return iter(
+                cached_rides.to_batches(max_chunksize=bigquery_client.RIDES_PAGE_SIZE)
+            )
+        # Rides are streamed page by page, so sending starts as soon as the first page arrives
+        rides_rows = bigquery_client.query_rides_data()
+        cls.total_messages = rides_rows.total_rows or 0
+        rides_batches = bigquery_client.iter_rides_batches(rides_rows)
+        if rides_cache is not None:
+            rides_batches = rides_cache.write(cache_key, rides_batches)
+        return rides_batches
 
-    # Delivery callback function to handle message delivery reports
     @staticmethod
-    def delivery_callback(error, message):
-        if error is not None:
-            logging.error(f"Message delivery failed: {error}")
-        else:
-            logging.info(
-                f"Message delivered to topic '{message.topic()}' partition [{message.partition()}] offset {message.offset()}"
+    def iter_rides(rides_batches, columnar, avro_encoder=None, key_field=None):
+        """
+        Yields `(event_time, (key, ride))` pairs from the rides record batches.
+
+        The message key is the ride's `key_field` value as a string, or None without a `key_field`.
+        In columnar mode, every batch is encoded to JSON at once, so each ride is yielded as its
+        encoded bytes rather than a dict.
+        With an `avro_encoder`, rides are always yielded as Avro encoded bytes.
+        """
+        # pyarrow is only imported once rides are sent, it is slow to import
+        import pyarrow as pa
+
+        from arrow_json import ArrowJsonEncoder
+
+        json_encoder = ArrowJsonEncoder()
+        for batch in rides_batches:
+            event_times = json_encoder.event_times(batch, "timestamp_at_stop")
+            if key_field:
+                keys = batch.column(key_field).cast(pa.string()).to_pylist()
+            else:
+                keys = [None] * batch.num_rows
+            if avro_encoder is not None:
+                rides = [avro_encoder.encode(ride) for ride in batch.to_pylist()]
+            elif columnar:
+                rides = json_encoder.encode(batch)
+            else:
+                rides = batch.to_pylist()
+            yield from zip(event_times, zip(keys, rides))
+
+    @staticmethod
+    def build_message(message_id, ride_data, avro_encoder=None):
+        if avro_encoder is not None:
+            return avro_encoder.encode_message(message_id, time.time(), ride_data)
+        if isinstance(ride_data, bytes):
+            return b'{"id":%d,"timestamp":%r,"data":%s}' % (
+                message_id,
+                time.time(),
+                ride_data,
             )
+        return {
+            "id": message_id,
+            "timestamp": time.time(),
+            "data": ride_data,
+        }
 
     @classmethod
     def start_kafka_messages_stream(
-        cls, stop_event, bootstrap_servers, topic, interval_seconds=1
+        cls,
+        stop_event,
+        bootstrap_servers,
+        topic,
+        interval_seconds=1,
+        messages_per_second=None,
+        speed_up=None,
+        columnar=True,
+        wire_format="json",
+        schema_registry=None,
+        key_field="bus_line_id",
+        partitioner="murmur2_random",
+        num_workers=1,
+        log_sample_rate=0,
+        rides_cache=None,
     ):
-        """Continuously sends Kafka messages until the stop_event is set."""
+        """Continuously sends Kafka messages until the stop_event is set.
+
+        By default, every message is flushed, and messages are sent every `interval_seconds`.
+        When `messages_per_second` is set, messages are sent in batched mode instead:
+        they are produced at the target rate and kept in flight, delivery reports are
+        served with poll(), and the producers are flushed only once, when the stream ends.
+        When `speed_up` is set, rides are replayed in `timestamp_at_stop` order, on a
+        wall clock running `speed_up` times faster than the original events.
+        Rides are held as Arrow record batches, and with `columnar` they are also encoded a batch
+        at a time. With a `rides_cache`, the rides are read from a local cache when possible.
+        With `wire_format="avro"`, messages are encoded as Avro binary instead of JSON, using
+        the `<topic>-value` schema from the `schema_registry` location.
+        Messages are keyed by the ride's `key_field`, so updates of the same bus line (or ride)
+        always go to the same partition, in order. The `partitioner` is a librdkafka partitioner.
+        Rides are sharded by key across `num_workers` threads, each with its own producer.
+        The rate applies to all workers combined.
+        Deliveries are logged as aggregated metrics, and individual messages only for a
+        `log_sample_rate` fraction of them.
+        """
+        if num_workers < 1:
+            raise ValueError(f"num_workers must be at least 1, got {num_workers}")
         # Get data from the past, with updated timestamps to simulate new data
         bigquery_client = BigQueryService(os.getenv("BQ_DATASET"))
-        rides_data = bigquery_client.get_rides_data()
-        cls.total_messages = len(rides_data)
-        # create kafka producer instance
-        producer_instance = cls.get_kafka_producer(bootstrap_servers)
-        logging.info(f"Got {len(rides_data)} rides data.")
-        cls.sent_messages = 0
-        while not stop_event.is_set() and cls.sent_messages < len(rides_data):
-            ride_data = rides_data[cls.sent_messages]
-
-            cls.sent_messages += 1
-            message = {
-                "id": cls.sent_messages,
-                "timestamp": time.time(),
-                "data": ride_data,
-            }
-            logging.info(f"Sending message {cls.sent_messages}")
+        rides_batches = cls.get_rides_batches(bigquery_client, rides_cache)
+        logging.info(f"Got {cls.total_messages} rides data.")
+        cls.worker_sent_messages = [0] * num_workers
+        cls.delivery_metrics = DeliveryMetrics(log_sample_rate=log_sample_rate)
+        cls.producers = []
+        avro_encoder = None
+        if wire_format == "avro":
+            from avro_encoder import AvroRideEncoder
+            from schema_registry import FileSchemaRegistry
+
+            schema = FileSchemaRegistry(schema_registry).get_schema(f"{topic}-value")
+            avro_encoder = AvroRideEncoder(schema)
+        rides = cls.iter_rides(rides_batches, columnar, avro_encoder, key_field)
+        if speed_up is not None:
+            # the scheduler takes care of the pacing
+            rides = ReplayScheduler(speed_up).replay(rides, stop_event)
+            rate_limiter = None
+        else:
+            rides = (ride for _, ride in rides)
+            rate_limiter = RateLimiter(
+                1 / interval_seconds
+                if messages_per_second is None
+                else messages_per_second
+            )
+        flush_every_message = speed_up is None and messages_per_second is None
+
+        worker_queues = [
+            queue.Queue(maxsize=cls.WORKER_QUEUE_SIZE) for _ in range(num_workers)
+        ]
+        # a failed worker stops the stream, and its error fails it once the workers are done
+        worker_errors = []
+        workers = [
+            threading.Thread(
+                target=cls.run_worker_until_error,
+                args=(
+                    worker_errors,
+                    worker_index,
+                    worker_queues[worker_index],
+                    stop_event,
+                    bootstrap_servers,
+                    topic,
+                    partitioner,
+                    rate_limiter,
+                    flush_every_message,
+                    avro_encoder,
+                ),
+                name=f"kafka-producer-{worker_index}",
+                daemon=True,
+            )
+            for worker_index in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for message_id, (key, ride_data) in enumerate(rides, start=1):
+            # rides of the same key are always sent by the same worker, to keep them in order
+            if key is None:
+                worker_index = message_id % num_workers
+            else:
+                worker_index = hash(key) % num_workers
+            item = (message_id, key, ride_data)
+            if not cls.put_ride(worker_queues[worker_index], item, stop_event):
+                break
+        for worker_queue in worker_queues:
+            cls.put_ride(worker_queue, None, stop_event)
+        for worker in workers:
+            worker.join()
+        cls.delivery_metrics.flush()
+        stop_event.set()
+        if worker_errors:
+            raise worker_errors[0]
+        logging.info("Kafka continuous producer stopped.")
+
+    @staticmethod
+    def put_ride(worker_queue, item, stop_event):
+        """Puts a ride in a worker queue. Returns False if the stop event fired while waiting."""
+        while not stop_event.is_set():
             try:
-                producer_instance.produce(
-                    topic, value=message, on_delivery=cls.delivery_callback
-                )
-                producer_instance.flush()  # ensure sending message
+                worker_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @classmethod
+    def run_worker_until_error(
+        cls, worker_errors, worker_index, worker_queue, stop_event, *args
+    ):
+        """Runs a producer worker, recording its error and stopping the stream if it fails."""
+        try:
+            cls.run_producer_worker(worker_index, worker_queue, stop_event, *args)
+        except Exception as e:
+            logging.exception(e)
+            worker_errors.append(e)
+            stop_event.set()
+
+    @classmethod
+    def run_producer_worker(
+        cls,
+        worker_index,
+        worker_queue,
+        stop_event,
+        bootstrap_servers,
+        topic,
+        partitioner,
+        rate_limiter,
+        flush_every_message,
+        avro_encoder,
+    ):
+        """Sends the rides from `worker_queue`, until it is exhausted or the stop_event is set."""
+        producer_instance = cls.create_kafka_producer(bootstrap_servers, partitioner)
+        cls.producers.append(producer_instance)
+        while not stop_event.is_set():
+            try:
+                item = worker_queue.get(timeout=0.1)
+            except queue.Empty:
+                producer_instance.poll(0)
+                continue
+            if item is None:
+                break
+            message_id, key, ride_data = item
+            if rate_limiter is not None:
+                # serve delivery reports until the next message is due
+                producer_instance.poll(rate_limiter.reserve())
+
+            message = cls.build_message(message_id, ride_data, avro_encoder)
+            if cls.delivery_metrics.should_sample():
+                logging.info(f"Sending message {message_id}")
+            try:
+                cls.produce_message(producer_instance, topic, message, key)
+                if flush_every_message:
+                    producer_instance.flush()  # ensure sending message
+                else:
+                    producer_instance.poll(0)
             except KafkaException as e:
                 logging.exception(e)
             except Exception as e:
                 logging.exception(e)
-            time.sleep(interval_seconds)
-        stop_event.set()
-        logging.info("Kafka continuous producer stopped.")
+            cls.worker_sent_messages[worker_index] += 1
+        # deliver everything that is still in flight
+        producer_instance.flush()
+
+    @classmethod
+    def get_queue_depth(cls):
+        """Number of messages waiting to be sent, or waiting for their delivery report."""
+        return sum(len(producer_instance) for producer_instance in cls.producers)
 
     @classmethod
     def get_stats(cls):
         return {
             "total_messages": cls.total_messages,
-            "sent_messages": cls.sent_messages,
+            "sent_messages": sum(cls.worker_sent_messages),
+            "queue_depth": cls.get_queue_depth(),
+            "delivery": cls.delivery_metrics.get_stats(),
+            "workers": [
+                {"worker": worker_index, "sent_messages": sent_messages}
+                for worker_index, sent_messages in enumerate(cls.worker_sent_messages)
+            ],
         }
 
+    @classmethod
+    def get_prometheus_metrics(cls):
+        lines = prometheus_metric(
+            "kafka_producer_total_messages",
+            "gauge",
+            "Rides to be sent by the kafka simulation.",
+            {"": cls.total_messages},
+        )
+        lines += prometheus_metric(
+            "kafka_producer_sent_messages_total",
+            "counter",
+            "Messages handed to the producers, by worker.",
+            {
+                f'{{worker="{worker_index}"}}': sent_messages
+                for worker_index, sent_messages in enumerate(cls.worker_sent_messages)
+            },
+        )
+        lines += prometheus_metric(
+            "kafka_producer_queue_depth",
+            "gauge",
+            "Messages waiting to be sent, or waiting for their delivery report.",
+            {"": cls.get_queue_depth()},
+        )
+        lines += cls.delivery_metrics.to_prometheus()
+        return "\n".join(lines) + "\n"
+
 
 """
 
@@ -12,16 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import hashlib
 import logging
 import os
+import tempfile
 import threading  # Used to manage the stop signal for the background task
-
-from flask import Flask, render_template, jsonify
+import time
+import uuid
+
+from flask import (
+    Flask,
+    Response,
+    render_template,
+    jsonify,
+    request,
+    stream_with_context,
+)
 from flask_executor import Executor
 
 from bq_service import BigQueryService
+from bus_line_store import BusLineConsumer, BusLineStore
 from kafka_service import KafkaService
 from pyspark_service import PySparkService
+from rides_cache import RidesCache
+from shared_state import SharedState
+from status_broadcaster import StatusBroadcaster
 
 templates_dir = os.path.join(os.path.dirname(__file__), "templates")
 
@@ -33,11 +49,76 @@ REGION = os.environ["REGION"]
 KAFKA_BOOTSTRAP = os.environ["KAFKA_BOOTSTRAP"]
 KAFKA_TOPIC = os.environ["KAFKA_TOPIC"]
 KAFKA_ALERT_TOPIC = os.environ["KAFKA_ALERT_TOPIC"]
+# Optional - compacted topic the spark job publishes the bus state to, served from memory
+KAFKA_STATE_TOPIC = os.environ.get("KAFKA_STATE_TOPIC", "")
+# Consume the alerts (and state) topics into memory, instead of only reading BigQuery
+KAFKA_CONSUME_BUS_UPDATES = (
+    os.environ.get("KAFKA_CONSUME_BUS_UPDATES", "true").lower() == "true"
+)
 SPARK_TMP_BUCKET = os.environ["SPARK_TMP_BUCKET"]
 SPARK_CHECKPOINT_LOCATION = os.environ["SPARK_CHECKPOINT_LOCATION"]
 BIGQUERY_TABLE = os.environ["BIGQUERY_TABLE"]
 SUBNET_URI = os.environ["SUBNET_URI"]
+# Optional - micro-batch tuning of the spark job, e.g. a trigger interval of "10 seconds"
+SPARK_TRIGGER_INTERVAL = os.environ.get("SPARK_TRIGGER_INTERVAL") or None
+SPARK_MAX_OFFSETS_PER_TRIGGER = (
+    int(os.environ["SPARK_MAX_OFFSETS_PER_TRIGGER"])
+    if os.environ.get("SPARK_MAX_OFFSETS_PER_TRIGGER")
+    else None
+)
+SPARK_MIN_OFFSETS_PER_TRIGGER = (
+    int(os.environ["SPARK_MIN_OFFSETS_PER_TRIGGER"])
+    if os.environ.get("SPARK_MIN_OFFSETS_PER_TRIGGER")
+    else None
+)
+SPARK_MAX_TRIGGER_DELAY = os.environ.get("SPARK_MAX_TRIGGER_DELAY") or None
+SPARK_SHUFFLE_PARTITIONS = (
+    int(os.environ["SPARK_SHUFFLE_PARTITIONS"])
+    if os.environ.get("SPARK_SHUFFLE_PARTITIONS")
+    else None
+)
+# Run the spark job as a single query, reading and parsing every bus update once
+SPARK_SINGLE_READ = os.environ.get("SPARK_SINGLE_READ", "false").lower() == "true"
 SERVICE_ACCOUNT = os.environ["SERVICE_ACCOUNT"]
+# Optional - when set, the kafka simulation runs in batched mode at this rate
+KAFKA_MESSAGES_PER_SECOND = (
+    float(os.environ["KAFKA_MESSAGES_PER_SECOND"])
+    if os.environ.get("KAFKA_MESSAGES_PER_SECOND")
+    else None
+)
+# Optional - when set, rides are replayed in event-time order, this many times faster
+KAFKA_REPLAY_SPEED_UP = (
+    float(os.environ["KAFKA_REPLAY_SPEED_UP"])
+    if os.environ.get("KAFKA_REPLAY_SPEED_UP")
+    else None
+)
+# Keep the replayed rides as Arrow record batches, encoded to JSON a batch at a time
+KAFKA_COLUMNAR = os.environ.get("KAFKA_COLUMNAR", "true").lower() == "true"
+# Either "json" or "avro" - used by both the kafka producer and the spark job
+KAFKA_WIRE_FORMAT = os.environ.get("KAFKA_WIRE_FORMAT", "json")
+# Location of the <topic>-value.avsc schemas, a local directory or a GCS prefix
+KAFKA_SCHEMA_REGISTRY = os.environ.get(
+    "KAFKA_SCHEMA_REGISTRY", f"gs://{GCS_MAIN_BUCKET}/code"
+)
+# Ride field used as the message key (e.g. bus_line_id or bus_ride_id), empty for no key
+KAFKA_MESSAGE_KEY = os.environ.get("KAFKA_MESSAGE_KEY", "bus_line_id")
+KAFKA_PARTITIONER = os.environ.get("KAFKA_PARTITIONER", "murmur2_random")
+# Number of producer threads the kafka simulation is sharded across
+KAFKA_PRODUCER_WORKERS = int(os.environ.get("KAFKA_PRODUCER_WORKERS", "1"))
+# Fraction of the kafka messages that are logged individually, on top of the aggregated metrics
+KAFKA_LOG_SAMPLE_RATE = float(os.environ.get("KAFKA_LOG_SAMPLE_RATE", "0"))
+# Local cache of the rides data replayed by the kafka simulation, disabled with a TTL of 0
+RIDES_CACHE_DIR = os.environ.get(
+    "RIDES_CACHE_DIR", os.path.join(tempfile.gettempdir(), "rides-cache")
+)
+RIDES_CACHE_TTL_SECONDS = float(os.environ.get("RIDES_CACHE_TTL_SECONDS", "3600"))
+# Open /events streams per worker, each holds one of the worker's GUNICORN_THREADS.
+# Past it, dashboards fall back to polling.
+EVENTS_MAX_CONNECTIONS = int(os.environ.get("EVENTS_MAX_CONNECTIONS", "16"))
+# State shared by the worker processes serving the app (see gunicorn.conf.py)
+SHARED_STATE_DIR = os.environ.get(
+    "SHARED_STATE_DIR", os.path.join(tempfile.gettempdir(), "buses-dashboard-state")
+)
 app = Flask(__name__, template_folder=templates_dir)
 executor = Executor(app)
 
@@ -46,15 +127,39 @@ app.config["bq_client"] = BigQueryService(BQ_DATASET)
 KAFKA_EVENT_KEY = "kafka_event"
 KAFKA_TASK_ID_KEY = "kafka_task_id"
 
+RIDES_CACHE_KEY = "rides_cache"
+
+# The kafka producer runs in one of the workers, which publishes its progress here
+KAFKA_TASK_STATE = "kafka-task"
+KAFKA_TASK_REPORT_SECONDS = 0.5
+
 SPARK_EVENT_KEY = "spark_event"
 SPARK_TASK_ID_KEY = "spark_task_id"
 
+# Set once the clients are created and the bus lines loaded, see /readyz
+READY_KEY = "ready"
+WARM_UP_RETRY_SECONDS = 5
+
 app.config[KAFKA_EVENT_KEY] = threading.Event()
 app.config[KAFKA_TASK_ID_KEY] = None
 
+app.config[RIDES_CACHE_KEY] = (
+    RidesCache(RIDES_CACHE_DIR, RIDES_CACHE_TTL_SECONDS)
+    if RIDES_CACHE_TTL_SECONDS > 0
+    else None
+)
+
 app.config[SPARK_EVENT_KEY] = threading.Event()
 app.config[SPARK_TASK_ID_KEY] = None
 
+app.config[READY_KEY] = threading.Event()
+
+shared_state = SharedState(SHARED_STATE_DIR)
+
+# Fed by a consumer started by the warm-up, see start_bus_line_consumer
+bus_line_store = BusLineStore() if KAFKA_CONSUME_BUS_UPDATES else None
+bus_line_consumer = None
+
 spark_service = PySparkService(
     PROJECT_ID,
     REGION,
@@ -68,56 +173,264 @@ spark_service = PySparkService(
     BIGQUERY_TABLE,
     SUBNET_URI,
     SERVICE_ACCOUNT,
+    wire_format=KAFKA_WIRE_FORMAT,
+    kafka_state_topic=KAFKA_STATE_TOPIC or None,
+    bus_line_store=bus_line_store,
+    shared_state=shared_state,
+    trigger_interval=SPARK_TRIGGER_INTERVAL,
+    max_offsets_per_trigger=SPARK_MAX_OFFSETS_PER_TRIGGER,
+    min_offsets_per_trigger=SPARK_MIN_OFFSETS_PER_TRIGGER,
+    max_trigger_delay=SPARK_MAX_TRIGGER_DELAY,
+    shuffle_partitions=SPARK_SHUFFLE_PARTITIONS,
+    single_read=SPARK_SINGLE_READ,
 )
 
 
+def get_spark_status(include_stats: bool = True, since: str = None) -> dict:
+    """
+    With `include_stats`, the state of the bus lines is added while the job is running - only
+    the lines that changed after cursor `since` if given, along with the removed ones.
+    """
+    # the status is polled in the background, this only reads the latest one
+    status = spark_service.status
+    status_dict = {**status.to_dict(), "updated_at": spark_service.status_updated_at}
+    if include_stats and status.is_running:
+        status_dict.update(spark_service.get_stats_since(since))
+    return status_dict
+
+
+def get_kafka_status() -> dict:
+    kafka_task = shared_state.read(KAFKA_TASK_STATE)
+    if kafka_task is None:
+        return {
+            "status": "inactive",
+            "message": "No kafka producer has been submitted.",
+        }
+    if kafka_task["status"] == "active" and not SharedState.is_alive(
+        kafka_task["owner"]
+    ):
+        return {
+            "status": "error",
+            "message": "Kafka producer job was lost, its worker process exited.",
+        }
+    return {
+        key: kafka_task[key]
+        for key in ("status", "message", "result", "stats")
+        if key in kafka_task
+    }
+
+
+def report_kafka_task(task_id: str, task, stop_event: threading.Event):
+    """
+    Publishes the progress of the kafka producer task running in this worker, and relays the
+    stop requests received by any worker, until the task is done.
+    """
+
+    def update_kafka_task(**values):
+        with shared_state.lock(KAFKA_TASK_STATE):
+            kafka_task = shared_state.read(KAFKA_TASK_STATE)
+            if kafka_task is None or kafka_task["task_id"] != task_id:
+                return None
+            kafka_task.update(values)
+            shared_state.write(KAFKA_TASK_STATE, kafka_task)
+            return kafka_task
+
+    while not task.done():
+        kafka_task = update_kafka_task(
+            stats=KafkaService.get_stats(),
+            metrics=KafkaService.get_prometheus_metrics(),
+        )
+        if kafka_task is not None and kafka_task["stop_requested"]:
+            stop_event.set()
+        time.sleep(KAFKA_TASK_REPORT_SECONDS)
+
+    stats = KafkaService.get_stats()
+    metrics = KafkaService.get_prometheus_metrics()
+    try:
+        result = task.result()
+    except Exception as e:
+        update_kafka_task(
+            status="error",
+            message=f"Kafka producer job failed with an exception: {e}",
+            stats=stats,
+            metrics=metrics,
+        )
+        return
+    # the stream sets the stop event itself when it ends, only a stop request means stopped
+    kafka_task = update_kafka_task()
+    if kafka_task is not None and kafka_task["stop_requested"]:
+        update_kafka_task(
+            status="inactive",
+            message="Kafka producer stopped.",
+            stats=stats,
+            metrics=metrics,
+        )
+        return
+    update_kafka_task(
+        status="finished",
+        message="Kafka producer job has completed.",
+        result=str(result),
+        stats=stats,
+        metrics=metrics,
+    )
+
+
+def get_bus_state_since(since: str = None) -> dict | None:
+    """The bus lines changed after cursor `since` while the job is running, None otherwise."""
+    if not spark_service.status.is_running:
+        return None
+    return spark_service.get_stats_since(since)
+
+
+def get_active_bus_state() -> list:
+    return spark_service.get_stats() if spark_service.status.is_running else []
+
+
+# A single refresh loop pushes the status changes to every connected dashboard
+status_broadcaster = StatusBroadcaster(
+    {
+        "spark_status": lambda: get_spark_status(include_stats=False),
+        "kafka_status": get_kafka_status,
+    },
+    {"bus_state": (get_active_bus_state, "bus_line_id")},
+    json_dumps=app.json.dumps,
+    max_subscribers=EVENTS_MAX_CONNECTIONS,
+)
+
+
+def start_bus_line_consumer():
+    """
+    Starts consuming the bus line updates into the store, once. Creating the consumer fetches
+    a Kafka token right away, which is why it is not done while importing the app.
+    """
+    global bus_line_consumer
+    if bus_line_store is None or bus_line_consumer is not None:
+        return
+    bus_line_consumer = BusLineConsumer(
+        bus_line_store,
+        KafkaService.create_kafka_consumer(KAFKA_BOOTSTRAP),
+        KAFKA_ALERT_TOPIC,
+        KAFKA_STATE_TOPIC or None,
+    )
+    bus_line_consumer.start()
+
+
+def warm_up():
+    """
+    Creates the clients, starts the bus line consumer and loads the bus lines in the
+    background, so the server answers right away after starting, and the first requests do
+    not pay for the setup.
+    """
+    while True:
+        try:
+            spark_service.warm_up()
+            KafkaService.token_provider.get_credentials()
+            start_bus_line_consumer()
+            app.config["bq_client"].get_all_bus_lines()
+        except Exception as e:
+            logging.exception(e)
+            time.sleep(WARM_UP_RETRY_SECONDS)
+            continue
+        app.config[READY_KEY].set()
+        logging.info("Warm-up done, ready to serve.")
+        return
+
+
+threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    if app.config[READY_KEY].is_set():
+        return jsonify({"status": "ready"})
+    return jsonify({"status": "warming up"}), 503
+
+
+def conditional_response(payload: dict, etag_payload: dict) -> Response:
+    """
+    Returns `payload` as JSON, with an ETag computed from `etag_payload`, answering with a 304
+    when the client already has it.
+    """
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha1(app.json.dumps(etag_payload).encode()).hexdigest())
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def without_poll_time(status: dict) -> dict:
+    # the ETag leaves out the poll time, so unchanged states are answered with a 304
+    return {key: value for key, value in status.items() if key != "updated_at"}
+
+
 @app.route("/spark_status", methods=["GET"])
 def spark_status():
-    global spark_service
-    status = spark_service.get_job_status()
-    if status.is_running:
-        return jsonify({**status.to_dict(), "stats": spark_service.get_stats()})
-    else:
-        return jsonify(status.to_dict())
+    since = request.args.get("since")
+    status = get_spark_status(since=since)
+    return conditional_response(status, without_poll_time(status))
+
+
+@app.route("/status", methods=["GET"])
+async def status():
+    """
+    The spark status, the bus state and the kafka status in a single request, loaded
+    concurrently. The spark and kafka statuses are only read from memory and the shared state
+    files; the bus state is the one read that may wait on BigQuery (while the bus line store
+    does not have the state), so the others are answered without waiting behind it.
+    """
+    since = request.args.get("since")
+    spark, bus_state, kafka = await asyncio.gather(
+        asyncio.to_thread(get_spark_status, include_stats=False),
+        asyncio.to_thread(get_bus_state_since, since),
+        asyncio.to_thread(get_kafka_status),
+    )
+    if bus_state is not None:
+        spark.update(bus_state)
+    return conditional_response(
+        {"spark": spark, "kafka": kafka},
+        {"spark": without_poll_time(spark), "kafka": kafka},
+    )
 
 
 @app.route("/kafka_status", methods=["GET"])
 def kafka_status():
-    kafka_service = KafkaService()
-    if not app.config[KAFKA_TASK_ID_KEY]:
-        return jsonify(
-            {"status": "inactive", "message": "No kafka producer has been submitted."}
-        )
+    return jsonify(get_kafka_status())
 
-    if app.config[KAFKA_TASK_ID_KEY].running():
-        return jsonify(
-            {
-                "status": "active",
-                "message": "Kafka producer job is running.",
-                "stats": kafka_service.get_stats(),
-            }
-        )
 
-    if app.config[KAFKA_TASK_ID_KEY].done():
+@app.route("/events", methods=["GET"])
+def events():
+    subscription = status_broadcaster.subscribe()
+    if subscription is None:
+        # the browser closes the event source on an error status, and polls /status instead
+        return jsonify({"message": "Too many open event streams."}), 503
+
+    def stream():
         try:
-            result = app.config[KAFKA_TASK_ID_KEY].result()
-            return jsonify(
-                {
-                    "status": "finished",
-                    "message": "Kafka producer job has completed.",
-                    "result": str(result),
-                    "stats": kafka_service.get_stats(),
-                }
-            )
-        except Exception as e:
-            return jsonify(
-                {
-                    "status": "error",
-                    "message": f"Kafka producer job failed with an exception: {e}",
-                }
-            )
+            yield from status_broadcaster.stream(subscription)
+        finally:
+            status_broadcaster.unsubscribe(subscription)
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        # keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    return jsonify({"status": "unknown", "message": "Could not determine job status."})
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # the producer metrics live in the worker running the producer
+    kafka_task = shared_state.read(KAFKA_TASK_STATE)
+    if kafka_task is not None and kafka_task.get("metrics"):
+        kafka_metrics = kafka_task["metrics"]
+    else:
+        kafka_metrics = KafkaService.get_prometheus_metrics()
+    return Response(kafka_metrics, mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/start_spark_simulation", methods=["POST"])
@@ -140,10 +453,40 @@ def start_spark_simulation():
 
 @app.route("/start_kafka_simulation", methods=["POST"])
 def start_kafka_simulation():
-    if app.config[KAFKA_TASK_ID_KEY] is not None and not executor.futures.done(
-        app.config[KAFKA_TASK_ID_KEY]
-    ):
-        return jsonify({"message": "Producer is already running."})
+    messages_per_second = request.args.get(
+        "messages_per_second", default=KAFKA_MESSAGES_PER_SECOND, type=float
+    )
+    if messages_per_second is not None and messages_per_second <= 0:
+        return jsonify({"message": "messages_per_second must be positive."}), 400
+    speed_up = request.args.get("speed_up", default=KAFKA_REPLAY_SPEED_UP, type=float)
+    if speed_up is not None and speed_up <= 0:
+        return jsonify({"message": "speed_up must be positive."}), 400
+    columnar = request.args.get(
+        "columnar", default=KAFKA_COLUMNAR, type=lambda v: v.lower() == "true"
+    )
+    num_workers = request.args.get("workers", default=KAFKA_PRODUCER_WORKERS, type=int)
+    if num_workers < 1:
+        return jsonify({"message": "workers must be at least 1."}), 400
+
+    with shared_state.lock(KAFKA_TASK_STATE):
+        kafka_task = shared_state.read(KAFKA_TASK_STATE)
+        if (
+            kafka_task is not None
+            and kafka_task["status"] == "active"
+            and SharedState.is_alive(kafka_task["owner"])
+        ):
+            return jsonify({"message": "Producer is already running."})
+        task_id = str(uuid.uuid4())
+        shared_state.write(
+            KAFKA_TASK_STATE,
+            {
+                "task_id": task_id,
+                "owner": os.getpid(),
+                "status": "active",
+                "message": "Kafka producer job is running.",
+                "stop_requested": False,
+            },
+        )
 
     logging.info("Starting kafka producer...")
     # Reset the stop event and submit the continuous producer task
@@ -154,7 +497,23 @@ def start_kafka_simulation():
         app.config[KAFKA_EVENT_KEY],
         KAFKA_BOOTSTRAP,
         "bus-updates",
+        messages_per_second=messages_per_second,
+        speed_up=speed_up,
+        columnar=columnar,
+        wire_format=KAFKA_WIRE_FORMAT,
+        schema_registry=KAFKA_SCHEMA_REGISTRY,
+        key_field=KAFKA_MESSAGE_KEY,
+        partitioner=KAFKA_PARTITIONER,
+        num_workers=num_workers,
+        log_sample_rate=KAFKA_LOG_SAMPLE_RATE,
+        rides_cache=app.config[RIDES_CACHE_KEY],
     )
+    threading.Thread(
+        target=report_kafka_task,
+        args=(task_id, app.config[KAFKA_TASK_ID_KEY], app.config[KAFKA_EVENT_KEY]),
+        name="kafka-task-reporter",
+        daemon=True,
+    ).start()
     return jsonify({"message": "Kafka producer started in the background."})
 
 
@@ -172,6 +531,12 @@ def stop_spark_simulation():
 
 @app.route("/stop_kafka_simulation", methods=["POST"])
 def stop_kafka_simulation():
+    # the producer may run in another worker, which picks up the request from the shared state
+    with shared_state.lock(KAFKA_TASK_STATE):
+        kafka_task = shared_state.read(KAFKA_TASK_STATE)
+        if kafka_task is not None and kafka_task["status"] == "active":
+            kafka_task["stop_requested"] = True
+            shared_state.write(KAFKA_TASK_STATE, kafka_task)
     if app.config[KAFKA_EVENT_KEY]:
         app.config[KAFKA_EVENT_KEY].set()
     if app.config[KAFKA_TASK_ID_KEY]:
@@ -180,6 +545,13 @@ def stop_kafka_simulation():
     return jsonify({"message": "Kafka producer stopped."})
 
 
+@app.route("/invalidate_rides_cache", methods=["POST"])
+def invalidate_rides_cache():
+    if app.config[RIDES_CACHE_KEY]:
+        app.config[RIDES_CACHE_KEY].invalidate()
+    return jsonify({"message": "Rides cache invalidated."})
+
+
 @app.route("/")
 @app.route("/index")
 def index():
@@ -14,24 +14,76 @@
 
 from __future__ import annotations
 
+import contextlib
 import enum
+import functools
 import logging
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-
-from google.api_core import exceptions
-from google.cloud import dataproc_v1 as dataproc
-from google.cloud import storage
-from google.longrunning.operations_proto_pb2 import (
-    CancelOperationRequest,
-    GetOperationRequest,
-)
+from typing import TYPE_CHECKING
 
 from bq_service import BigQueryService
+from cache import CachedValue
+from versioned_rows import VersionedRows
+
+if TYPE_CHECKING:
+    from google.cloud import dataproc_v1 as dataproc
+    from google.cloud import storage
+
+    from bus_line_store import BusLineStore
+    from shared_state import SharedState
+
+# The google.cloud clients are imported where they are used, as they take a large share of
+# the startup time, see benchmarks/startup.py.
+
+
+def job_operation(method):
+    """
+    Pauses the status poller while the wrapped method updates the job status by itself.
+    With a shared state, operations are also serialized across all the worker processes.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # operations call each other (e.g. a retried start cancels the job first)
+        depth = getattr(self.operation_nesting, "depth", 0)
+        if depth == 0 and self.shared_state is not None:
+            lock = self.shared_state.lock("spark-job-operation")
+        else:
+            lock = contextlib.nullcontext()
+        with lock:
+            self.operation_nesting.depth = depth + 1
+            with self.operations_lock:
+                self.operations_in_progress += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.operation_nesting.depth = depth
+                with self.operations_lock:
+                    self.operations_in_progress -= 1
+                if depth == 0 and self.shared_state is not None:
+                    self.status_updated_at = time.time()
+                    self.publish_status()
+                # poll right away, to pick up the outcome of the operation
+                self.status_poll_requested.set()
+
+    return wrapper
 
 
 class PySparkService:
+    # The job status is polled in the background, quickly while the job is active
+    STATUS_POLL_ACTIVE_SECONDS = 2
+    STATUS_POLL_IDLE_SECONDS = 30
+    # How often workers that do not own the poller pick up the shared status
+    STATUS_SYNC_SECONDS = 1
+    # A single snapshot of the bus state is shared by all the dashboards, and refreshed in the
+    # background for as long as the dashboards keep asking for it.
+    BUS_STATE_REFRESH_SECONDS = 3
+    BUS_STATE_MAX_STALE_SECONDS = 30
+    BUS_STATE_IDLE_AFTER_SECONDS = 30
+
     def __init__(
         self,
         project_id: str,
@@ -46,6 +98,16 @@ class PySparkService:
         bigquery_table: str,
         subnet_uri: str,
         service_account: str,
+        wire_format: str = "json",
+        kafka_state_topic: str = None,
+        bus_line_store: BusLineStore = None,
+        shared_state: SharedState = None,
+        trigger_interval: str = None,
+        max_offsets_per_trigger: int = None,
+        min_offsets_per_trigger: int = None,
+        max_trigger_delay: str = None,
+        shuffle_partitions: int = None,
+        single_read: bool = False,
     ):
         self.project_id = project_id
         self.region = region
@@ -59,14 +121,73 @@ class PySparkService:
         self.bigquery_table = bigquery_table
         self.subnet_uri = subnet_uri
         self.service_account = service_account
+        self.wire_format = wire_format
+        # With a state topic, the job publishes the bus state to kafka too, and the store is
+        # fed from it - BigQuery is then only read until the store has the state.
+        self.kafka_state_topic = kafka_state_topic
+        self.bus_line_store = bus_line_store
+        # Shared by the worker processes - only one of them polls the job status
+        self.shared_state = shared_state
+        # Micro-batch tuning of the job, unset values keep the job's defaults
+        self.streaming_options = {
+            "trigger-interval": trigger_interval,
+            "max-offsets-per-trigger": max_offsets_per_trigger,
+            "min-offsets-per-trigger": min_offsets_per_trigger,
+            "max-trigger-delay": max_trigger_delay,
+            "shuffle-partitions": shuffle_partitions,
+        }
+        # Read the bus updates once, for both the alerts and the bus state
+        self.single_read = single_read
 
-        self.client = dataproc.BatchControllerClient(
-            client_options={"api_endpoint": f"{region}-dataproc.googleapis.com:443"}
-        )
+        # the clients are created on first use, see warm_up
         self.bq_service = BigQueryService(bigquery_dataset)
-        self.storage_client = storage.Client()
-        self.storage_bucket = self.storage_client.get_bucket(self.spark_tmp_bucket)
-        self.__status__ = self.get_job_status()
+        self.__status__ = JobStatus(
+            status=PySparkState.LOADING, message="Loading job status."
+        )
+        self.status_updated_at = None
+        self.status_poll_requested = threading.Event()
+        self.operations_lock = threading.Lock()
+        self.operations_in_progress = 0
+        self.operation_nesting = threading.local()
+        threading.Thread(
+            target=self.poll_job_status, name="spark-status-poller", daemon=True
+        ).start()
+        self.bus_state_versions = VersionedRows("bus_line_id")
+        self.bus_state = CachedValue(
+            lambda: self.bus_state_versions.update(self.load_bus_state()),
+            self.BUS_STATE_REFRESH_SECONDS,
+            self.BUS_STATE_MAX_STALE_SECONDS,
+        )
+        self.bus_state_read_at = None
+        threading.Thread(
+            target=self.refresh_bus_state, name="bus-state-refresher", daemon=True
+        ).start()
+
+    @functools.cached_property
+    def client(self) -> dataproc.BatchControllerClient:
+        from google.cloud import dataproc_v1 as dataproc
+
+        return dataproc.BatchControllerClient(
+            client_options={
+                "api_endpoint": f"{self.region}-dataproc.googleapis.com:443"
+            }
+        )
+
+    @functools.cached_property
+    def storage_client(self) -> storage.Client:
+        from google.cloud import storage
+
+        return storage.Client()
+
+    @functools.cached_property
+    def storage_bucket(self) -> storage.Bucket:
+        return self.storage_client.get_bucket(self.spark_tmp_bucket)
+
+    def warm_up(self):
+        """Creates the clients ahead of the first request that needs them."""
+        self.client
+        self.storage_bucket
+        self.bq_service.client
 
     @property
     def batch_id(self) -> str:
@@ -85,7 +206,17 @@ class PySparkService:
         return f"gs://{self.gcs_main_bucket}/code/pyspark-job.py"
 
     # noinspection PyTypeChecker
+    @job_operation
     def start_pyspark(self, stop_event, retry_count: int = 0):
+        from google.api_core import exceptions
+        from google.cloud import dataproc_v1 as dataproc
+
+        if retry_count == 0:
+            # another worker may have started the job while this one waited for its turn
+            status = self.get_job_status()
+            if status.is_running:
+                self.__status__ = status
+                return
         self.__status__ = JobStatus(
             status=PySparkState.PRE_RUN_CLEANUP, message="Cleaning up previous runs."
         )
@@ -101,8 +232,24 @@ class PySparkService:
                     f"--spark-tmp-bucket={self.spark_tmp_bucket}",
                     f"--spark-checkpoint-location={self.spark_checkpoint_location}",
                     f"--bigquery-table={self.bigquery_dataset}.{self.bigquery_table}",
+                    f"--wire-format={self.wire_format}",
+                    f"--avro-schema-file={self.kafka_topic}-value.avsc",
+                ]
+                + (
+                    [f"--kafka-state-topic={self.kafka_state_topic}"]
+                    if self.kafka_state_topic
+                    else []
+                )
+                + [
+                    f"--{name}={value}"
+                    for name, value in self.streaming_options.items()
+                    if value is not None
+                ]
+                + (["--single-read"] if self.single_read else []),
+                file_uris=[
+                    f"gs://{self.gcs_main_bucket}/code/ivySettings.xml",
+                    f"gs://{self.gcs_main_bucket}/code/{self.kafka_topic}-value.avsc",
                 ],
-                file_uris=[f"gs://{self.gcs_main_bucket}/code/ivySettings.xml"],
             ),
             runtime_config=dataproc.RuntimeConfig(
                 version="2.3",
@@ -110,6 +257,7 @@ class PySparkService:
                     "spark.jars.ivySettings": "./ivySettings.xml",
                     "spark.jars.packages": "org.apache.spark:spark-streaming-kafka-0-10_2.13:3.5.1,"
                     "org.apache.spark:spark-sql-kafka-0-10_2.13:3.5.1,"
+                    "org.apache.spark:spark-avro_2.13:3.5.1,"
                     "com.google.cloud.hosted.kafka:managed-kafka-auth-login-handler:1.0.5",
                 },
             ),
@@ -169,9 +317,49 @@ class PySparkService:
         )
 
     def get_stats(self):
-        return self.bq_service.get_bus_state(self.bigquery_table)
+        self.bus_state_read_at = time.monotonic()
+        if self.bus_line_store is not None and self.bus_line_store.has_state:
+            # served from memory, as fresh as the consumed state
+            return self.bus_state_versions.update(self.bus_line_store.get_rows())
+        return self.bus_state.get()
+
+    def load_bus_state(self):
+        loaded_at = time.monotonic()
+        rows = self.bq_service.get_bus_state(self.bigquery_table)
+        if self.bus_line_store is not None:
+            # the alerts consumed since are more recent than the table
+            rows = self.bus_line_store.apply_alerts(rows, loaded_at)
+        return rows
+
+    def get_stats_since(self, since: str = None) -> dict:
+        """Returns the bus lines whose state changed after cursor `since`, see `VersionedRows`."""
+        self.get_stats()
+        return self.bus_state_versions.changes_since(since)
 
+    def refresh_bus_state(self):
+        """Keeps the bus state snapshot fresh, for as long as it is being read."""
+        while True:
+            time.sleep(self.BUS_STATE_REFRESH_SECONDS)
+            read_at = self.bus_state_read_at
+            if read_at is None:
+                continue
+            if time.monotonic() - read_at > self.BUS_STATE_IDLE_AFTER_SECONDS:
+                continue
+            if self.bus_line_store is not None and self.bus_line_store.has_state:
+                continue
+            try:
+                self.bus_state.refresh()
+            except Exception as e:
+                logging.exception(e)
+
+    @job_operation
     def cancel_job(self):
+        from google.api_core import exceptions
+        from google.longrunning.operations_proto_pb2 import (
+            CancelOperationRequest,
+            GetOperationRequest,
+        )
+
         try:
             get_batch_operation = self.client.get_batch(
                 request={
@@ -231,7 +419,55 @@ class PySparkService:
             status=PySparkState.CANCELLED, message="Job cancelled."
         )
 
+    def poll_job_status(self):
+        """Keeps `status` up to date, polling quickly while the job is active and slowly when idle."""
+        while True:
+            if self.shared_state is None or self.shared_state.try_own(
+                "spark-status-poller"
+            ):
+                if not self.operations_in_progress:
+                    status = self.get_job_status()
+                    # an operation may have started meanwhile, its own status is more recent
+                    if not self.operations_in_progress:
+                        self.__status__ = status
+                        self.status_updated_at = time.time()
+                        if self.shared_state is not None:
+                            self.publish_status()
+                if self.status.is_running or self.status.status == PySparkState.LOADING:
+                    interval = self.STATUS_POLL_ACTIVE_SECONDS
+                else:
+                    interval = self.STATUS_POLL_IDLE_SECONDS
+            else:
+                self.sync_status()
+                interval = self.STATUS_SYNC_SECONDS
+            self.status_poll_requested.wait(interval)
+            self.status_poll_requested.clear()
+
+    def publish_status(self):
+        self.shared_state.write(
+            "spark-status",
+            {
+                "status": self.__status__.status.name,
+                "message": self.__status__.message,
+                "updated_at": self.status_updated_at,
+            },
+        )
+
+    def sync_status(self):
+        """Picks up the status published by the worker that owns the poller."""
+        shared_status = self.shared_state.read("spark-status")
+        if shared_status is None or self.operations_in_progress:
+            return
+        self.__status__ = JobStatus(
+            status=PySparkState[shared_status["status"]],
+            message=shared_status["message"],
+        )
+        self.status_updated_at = shared_status["updated_at"]
+
     def get_job_status(self) -> JobStatus:
+        from google.api_core import exceptions
+        from google.cloud import dataproc_v1 as dataproc
+
         try:
             operation = self.client.get_batch(request={"name": self.full_batch_id})
         except exceptions.NotFound:
@@ -278,7 +514,28 @@ class PySparkService:
         )
 
     def clear_bus_state(self):
-        self.bq_service.clear_table(self.bigquery_table)
+        """
+        Drops the bus lines of the previous run, from BigQuery, the state topic and the store,
+        so neither the dashboards nor a replay of the state topic show them again.
+        """
+        line_ids = set()
+        if self.kafka_state_topic:
+            line_ids.update(
+                row["bus_line_id"]
+                for row in self.bq_service.get_bus_state(self.bigquery_table)
+            )
+        self.bq_service.drop_table(self.bigquery_table)
+        if self.bus_line_store is not None:
+            line_ids.update(self.bus_line_store.get_line_ids())
+        if self.kafka_state_topic and line_ids:
+            from kafka_service import KafkaService
+
+            # the other workers' stores drop the lines when they consume the tombstones
+            KafkaService.delete_keys(
+                self.kafka_bootstrap, self.kafka_state_topic, sorted(line_ids)
+            )
+        if self.bus_line_store is not None:
+            self.bus_line_store.clear()
 
     def clear_previous_checkpoints(self):
         # List all blobs in the bucket
@@ -334,7 +591,8 @@ class JobStatus:
 
     @property
     def is_running(self):
-        return self.status.value < 10
+        # the status is unknown until the first poll, it is not reported as running meanwhile
+        return self.status != PySparkState.LOADING and self.status.value < 10
 
     def to_dict(self):
         return {
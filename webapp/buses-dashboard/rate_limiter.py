@@ -0,0 +1,42 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Spreads messages evenly over time, at `rate` messages per second.
+    A single limiter can be shared by several producer threads, to control their combined rate.
+    """
+
+    def __init__(self, rate: float):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.reserved = 0
+
+    def reserve(self) -> float:
+        """Reserves the next free slot, and returns the number of seconds to wait until it is due."""
+        with self.lock:
+            now = time.monotonic()
+            if self.started_at is None:
+                self.started_at = now
+            due_at = self.started_at + self.reserved / self.rate
+            self.reserved += 1
+        return max(due_at - now, 0)
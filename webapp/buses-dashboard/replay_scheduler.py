@@ -0,0 +1,71 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+import time
+
+
+class ReplayScheduler:
+    """
+    Replays records in event-time order, on a wall clock compressed by `speed_up`.
+
+    Records are given as `(event_time, record)` pairs, with the event time in seconds, and are
+    expected to arrive (mostly) sorted by it. A bounded heap is used as a reorder buffer, so
+    memory stays flat no matter how many records are replayed.
+    """
+
+    # Never block for longer than this, so a stop request is noticed quickly
+    MAX_WAIT_SECONDS = 0.5
+
+    def __init__(self, speed_up: float = 1.0, reorder_buffer_size: int = 10000):
+        if speed_up <= 0:
+            raise ValueError(f"speed_up must be positive, got {speed_up}")
+        self.speed_up = speed_up
+        self.reorder_buffer_size = reorder_buffer_size
+        self.first_event_time = None
+        self.started_at = None
+
+    def replay(self, records, stop_event, wait=time.sleep):
+        """
+        Yields `records` in event-time order, each one when it is due on the compressed clock.
+
+        `wait` is called with the number of seconds to wait - pass a producer's poll() to keep
+        serving delivery reports while waiting for the next record.
+        """
+        heap = []
+        sequence = itertools.count()  # keeps the heap stable for equal event times
+        for event_time, record in records:
+            heapq.heappush(heap, (event_time, next(sequence), record))
+            if len(heap) > self.reorder_buffer_size:
+                if not self.wait_until_due(heap[0][0], stop_event, wait):
+                    return
+                yield heapq.heappop(heap)[2]
+        while heap:
+            if not self.wait_until_due(heap[0][0], stop_event, wait):
+                return
+            yield heapq.heappop(heap)[2]
+
+    def wait_until_due(self, event_time: float, stop_event, wait) -> bool:
+        """Waits until `event_time` is due. Returns False if the stop event fired meanwhile."""
+        if self.started_at is None:
+            self.first_event_time = event_time
+            self.started_at = time.monotonic()
+        due_at = self.started_at + (event_time - self.first_event_time) / self.speed_up
+        while not stop_event.is_set():
+            remaining = due_at - time.monotonic()
+            if remaining <= 0:
+                return True
+            wait(min(remaining, self.MAX_WAIT_SECONDS))
+        return False
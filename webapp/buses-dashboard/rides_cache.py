@@ -0,0 +1,95 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import glob
+import logging
+import os
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+class RidesCache:
+    """
+    Caches the rides query results on local disk, as Arrow IPC files.
+
+    Cached files are memory-mapped when read, so replaying them neither queries BigQuery nor
+    copies the data. Entries are keyed by the query dataset and window, and expire after
+    `ttl_seconds`.
+    """
+
+    def __init__(self, directory: str, ttl_seconds: float = 3600):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"rides-{key}.arrow")
+
+    def read(self, key: str) -> "pa.Table | None":
+        """Returns the memory-mapped cached rides, or None if they are missing or expired."""
+        path = self.path(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        if age > self.ttl_seconds:
+            logging.info(
+                f"Rides cache {path} expired {age:.0f} seconds after creation."
+            )
+            self.invalidate(key)
+            return None
+        import pyarrow as pa
+
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def write(self, key: str, batches):
+        """
+        Passes `batches` through, while writing them to the cache.
+        The cache entry is only created once all the batches were consumed.
+        """
+        import pyarrow as pa
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        writer = None
+        try:
+            for batch in batches:
+                if writer is None:
+                    writer = pa.ipc.new_file(tmp_path, batch.schema)
+                writer.write_batch(batch)
+                yield batch
+            if writer is not None:
+                writer.close()
+                writer = None
+                os.replace(tmp_path, path)
+                logging.info(f"Cached rides data in {path}.")
+        finally:
+            # the batches were not fully consumed, e.g. the stream was stopped
+            if writer is not None:
+                writer.close()
+                os.remove(tmp_path)
+
+    def invalidate(self, key: str = None):
+        """Removes a cache entry, or all of them when no `key` is given."""
+        paths = [self.path(key)] if key else glob.glob(self.path("*"))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,48 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+
+
+class FileSchemaRegistry:
+    """
+    A file based stand-in for a schema registry.
+
+    Avro schemas are stored as `<subject>.avsc` files, following the `<topic>-value` subject
+    naming convention, in either a local directory or a GCS prefix (gs://bucket/path).
+    """
+
+    def __init__(self, location: str):
+        self.location = location.rstrip("/")
+        self.schemas = {}
+
+    def get_schema(self, subject: str) -> dict:
+        if subject not in self.schemas:
+            self.schemas[subject] = json.loads(
+                self.read(f"{self.location}/{subject}.avsc")
+            )
+        return self.schemas[subject]
+
+    @staticmethod
+    def read(path: str) -> str:
+        if path.startswith("gs://"):
+            from google.cloud import storage
+
+            bucket_name, _, blob_name = path.removeprefix("gs://").partition("/")
+            return (
+                storage.Client().bucket(bucket_name).blob(blob_name).download_as_text()
+            )
+        with open(path) as schema_file:
+            return schema_file.read()
@@ -0,0 +1,89 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import contextlib
+import fcntl
+import json
+import os
+import threading
+
+
+class SharedState:
+    """
+    Small JSON records and locks shared by all the worker processes of the webapp, as files in
+    a local directory.
+
+    Records are replaced atomically, so readers never see a partial write. Background work that
+    must run once for all the workers (e.g. polling an API) is given to a single owner process
+    with `try_own`; ownership moves to another process when the owner exits.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.owned = {}
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.json")
+
+    def read(self, name: str, default=None):
+        try:
+            with open(self.path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def write(self, name: str, value):
+        path = self.path(name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f, default=str)
+        os.replace(tmp_path, path)
+
+    @contextlib.contextmanager
+    def lock(self, name: str):
+        """An exclusive lock across processes and threads. Not reentrant."""
+        with open(os.path.join(self.directory, f"{name}.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def try_own(self, name: str) -> bool:
+        """
+        Makes this process the owner of `name`, unless another living process already is.
+        Returns whether this process is the owner, which it stays until it exits.
+        """
+        if name in self.owned:
+            return True
+        f = open(os.path.join(self.directory, f"{name}.owner"), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self.owned[name] = f
+        return True
+
+    @staticmethod
+    def is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
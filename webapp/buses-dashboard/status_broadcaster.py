@@ -0,0 +1,152 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import logging
+import queue
+import threading
+import time
+
+
+class StatusBroadcaster:
+    """
+    Pushes status changes to any number of subscribers, from a single refresh loop.
+
+    Every `refresh_seconds`, each source is loaded once, no matter how many clients are
+    connected, and only the values that changed are published. Keyed sources (lists of rows,
+    like the bus state) are published as deltas: the rows that changed, and the keys that are
+    gone. New subscribers first receive a full snapshot of every source.
+
+    Every subscriber holds a serving thread for as long as it is connected, so at most
+    `max_subscribers` are accepted, leaving the other threads to the rest of the requests.
+    """
+
+    REFRESH_SECONDS = 0.5
+    # Comment lines sent to idle subscribers, so dropped connections are noticed
+    KEEP_ALIVE_SECONDS = 15
+    # A subscriber this far behind is sent a full snapshot instead of its backlog
+    SUBSCRIBER_QUEUE_SIZE = 100
+
+    def __init__(
+        self,
+        sources: dict,
+        keyed_sources: dict = None,
+        refresh_seconds: float = REFRESH_SECONDS,
+        json_dumps=json.dumps,
+        max_subscribers: int = None,
+    ):
+        """
+        `sources` maps event names to loaders of JSON serializable values, and `keyed_sources`
+        maps event names to `(loader, key_field)` pairs, the loader returning a list of rows.
+        """
+        self.sources = sources
+        self.keyed_sources = keyed_sources or {}
+        self.refresh_seconds = refresh_seconds
+        self.json_dumps = json_dumps
+        self.max_subscribers = max_subscribers
+        self.condition = threading.Condition()
+        self.subscribers = set()
+        self.latest = {}
+        self.latest_rows = {name: {} for name in self.keyed_sources}
+        threading.Thread(
+            target=self.run, name="status-broadcaster", daemon=True
+        ).start()
+
+    def subscribe(self) -> queue.Queue | None:
+        """Returns a new subscription, or None when `max_subscribers` are already connected."""
+        subscription = queue.Queue(self.SUBSCRIBER_QUEUE_SIZE)
+        with self.condition:
+            if (
+                self.max_subscribers is not None
+                and len(self.subscribers) >= self.max_subscribers
+            ):
+                return None
+            self.put_snapshot(subscription)
+            self.subscribers.add(subscription)
+            self.condition.notify()
+        return subscription
+
+    def unsubscribe(self, subscription: queue.Queue):
+        with self.condition:
+            self.subscribers.discard(subscription)
+
+    def stream(self, subscription: queue.Queue):
+        """Yields the events of `subscription` in the text/event-stream format."""
+        while True:
+            try:
+                event, data = subscription.get(timeout=self.KEEP_ALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: {event}\ndata: {self.json_dumps(data)}\n\n"
+
+    def run(self):
+        while True:
+            with self.condition:
+                # nothing is loaded while no one is listening
+                while not self.subscribers:
+                    self.condition.wait()
+            started_at = time.monotonic()
+            self.refresh()
+            time.sleep(max(0.0, self.refresh_seconds - (time.monotonic() - started_at)))
+
+    def refresh(self):
+        for name, loader in self.sources.items():
+            try:
+                value = loader()
+            except Exception as e:
+                logging.exception(e)
+                continue
+            if name not in self.latest or value != self.latest[name]:
+                with self.condition:
+                    self.latest[name] = value
+                    self.publish(name, value)
+        for name, (loader, key_field) in self.keyed_sources.items():
+            try:
+                rows = {row[key_field]: row for row in loader()}
+            except Exception as e:
+                logging.exception(e)
+                continue
+            previous = self.latest_rows[name]
+            updated = [row for key, row in rows.items() if previous.get(key) != row]
+            removed = [key for key in previous if key not in rows]
+            if updated or removed:
+                with self.condition:
+                    self.latest_rows[name] = rows
+                    self.publish(
+                        name, {"full": False, "updated": updated, "removed": removed}
+                    )
+
+    def publish(self, event: str, data):
+        """Queues an event for every subscriber. Must be called holding the condition."""
+        for subscription in self.subscribers:
+            try:
+                subscription.put_nowait((event, data))
+            except queue.Full:
+                # a slow client, drop its backlog and send it the current state from scratch
+                self.put_snapshot(subscription)
+
+    def put_snapshot(self, subscription: queue.Queue):
+        while not subscription.empty():
+            try:
+                subscription.get_nowait()
+            except queue.Empty:
+                break
+        for name, value in self.latest.items():
+            subscription.put_nowait((name, value))
+        for name, rows in self.latest_rows.items():
+            subscription.put_nowait(
+                (name, {"full": True, "updated": list(rows.values()), "removed": []})
+            )
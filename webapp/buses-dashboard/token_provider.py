@@ -15,12 +15,9 @@
 import base64
 import datetime
 import json
+import threading
 import time
 
-import google.auth
-import urllib3
-from google.auth.transport.urllib3 import Request
-
 
 def encode(source):
     """Safe base64 encoding."""
@@ -35,10 +32,22 @@ class TokenProvider(object):
     HEADER = json.dumps({"typ": "JWT", "alg": "GOOG_OAUTH2_TOKEN"})
 
     def __init__(self, **config):
-        self.credentials, _project = google.auth.default()
-        self.http_client = urllib3.PoolManager()
+        # loaded on first use, so creating a provider does not block on the credentials lookup
+        self.credentials = None
+        self.credentials_lock = threading.Lock()
+        self.http_client = None
 
     def get_credentials(self):
+        # google.auth and its transport are slow to import, and only needed for tokens
+        import google.auth
+        import urllib3
+        from google.auth.transport.urllib3 import Request
+
+        if self.credentials is None:
+            with self.credentials_lock:
+                if self.credentials is None:
+                    self.credentials, _project = google.auth.default()
+                    self.http_client = urllib3.PoolManager()
         if not self.credentials.valid:
             self.credentials.refresh(Request(self.http_client))
         return self.credentials
@@ -0,0 +1,89 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+import uuid
+
+
+class VersionedRows:
+    """
+    The latest rows of a table keyed by `key_field`, each one tagged with the version it last
+    changed at, so readers can ask only for what changed since the version they have.
+
+    Versions are microsecond timestamps (bumped when needed to stay strictly increasing).
+    Readers are given them as cursors prefixed with the epoch of this instance: every worker
+    process has its own rows, and only knows the removals it saw itself, so a cursor from
+    another process (or from before a restart) is answered with all the rows.
+    """
+
+    def __init__(self, key_field: str):
+        self.key_field = key_field
+        self.epoch = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.version = 0
+        self.rows = {}  # key -> (version, row)
+        self.removed = {}  # key -> version
+
+    def update(self, rows: list) -> list:
+        """Replaces the rows, bumping the version if anything changed. Returns `rows`."""
+        latest = {row[self.key_field]: row for row in rows}
+        with self.lock:
+            version = max(self.version + 1, time.time_ns() // 1000)
+            changed = False
+            for key, row in latest.items():
+                current = self.rows.get(key)
+                if current is None or current[1] != row:
+                    self.rows[key] = (version, row)
+                    self.removed.pop(key, None)
+                    changed = True
+            for key in [key for key in self.rows if key not in latest]:
+                del self.rows[key]
+                self.removed[key] = version
+                changed = True
+            if changed:
+                self.version = version
+        return rows
+
+    def changes_since(self, cursor: str = None) -> dict:
+        """
+        Returns the cursor of the current version, with the rows that changed and the keys
+        that were removed after `cursor`. All the rows are returned, flagged as `full`, when
+        `cursor` is missing or was not issued by this instance.
+        """
+        since = self.parse_cursor(cursor)
+        with self.lock:
+            full = since is None or since > self.version
+            if full:
+                since = -1
+            return {
+                "version": f"{self.epoch}-{self.version}",
+                "full": full,
+                "stats": [
+                    row for version, row in self.rows.values() if version > since
+                ],
+                "removed": [
+                    key for key, version in self.removed.items() if version > since
+                ],
+            }
+
+    def parse_cursor(self, cursor: str | None) -> int | None:
+        """The version of a cursor issued by this instance, None for any other cursor."""
+        if cursor is None:
+            return None
+        epoch, _, version = cursor.partition("-")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)